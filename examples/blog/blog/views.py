@@ -1,4 +1,7 @@
 from datetime import datetime
+
+from lunar.template import Markup
+
 from . import app, db
 from .models import Comment, Post, Tag
 from .renderer import md_renderer
@@ -42,7 +45,8 @@ def create_post():
 @app.route("/post/<int:id>")
 def show_post(id):
     p = Post.get(id=id)
-    p.content = md_renderer.render(p.content)
+    # rendered html, output as is by the template.
+    p.content = Markup(md_renderer.render(p.content))
     return app.render("post.html", post=p)
 
 
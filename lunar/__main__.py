@@ -0,0 +1,7 @@
+# python -m lunar compile templates/, see lunar.template.main
+
+import sys
+
+from .template import main
+
+sys.exit(main())
@@ -19,15 +19,19 @@ Happy hacking.
 
 """
 
+import asyncio
+import contextvars
+import inspect
 import json
 import os
 import time
 import sys
 import traceback
 import threading
-import mimetypes
 
-from functools import wraps
+from collections import ChainMap
+from functools import partial, wraps
+from types import MappingProxyType
 
 if sys.version < "3":
     from urllib import quote
@@ -47,10 +51,12 @@ except (ImportError, AttributeError):
 
 from .server import ServerAdapter
 from .server import WSGIRefServer
+from .server import server_names
+from .static import StaticIndex
 from .template import Loader, unescape
-from .wrappers import Request, Response
-from .router import Router, RouterException
-from .util import _Stack
+from .wrappers import Request, Response, environ_from_asgi
+from .router import Router, RouterException, MethodNotAllowed
+from .util import _Stack, LRUCache, parse_range
 
 
 class LunarException(Exception):
@@ -60,21 +66,64 @@ class LunarException(Exception):
         self._response.set_status(code)
         self._server_handler = server_handler
 
-    def __call__(self):
+    def build(self):
         body = self._response.status
         if self._debug:
             body = "<br>".join(
                 [self._response.status, traceback.format_exc().replace("\n", "<br>")]
             )
         self._response.set_body(body)
+        return self._response
+
+    def __call__(self):
+        self.build()
         self._server_handler(self._response.status, self._response.headerlist)
         return [self._response.body]
 
 
+def _started(stream):
+    """Run a streamed body up to its first chunk, then chain the chunk back.
+
+    The errors of a template, like a missing name, raise before the
+    response is started and become a 500 instead of a broken 200 body.
+    """
+    first = next(stream, None)
+
+    def body():
+        try:
+            if first is not None:
+                yield first
+                yield from stream
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+
+    return body()
+
+
+class _RequestContext(object):
+
+    """The request and response of the request being handled.
+
+    Lunar keeps it in a contextvars.ContextVar, so every thread and every
+    asyncio task sees its own request, nothing is stored on the shared
+    application object.
+    """
+
+    __slots__ = ("request", "response")
+
+    def __init__(self, request, response):
+        self.request = request
+        self.response = response
+
+
 """
 The Main object of lunar.
 """
 
+# Number of static file URLs url_for keeps, per host and file.
+_STATIC_URL_CAPACITY = 1024
+
 
 class Lunar(object):
 
@@ -85,9 +134,10 @@ class Lunar(object):
         # router
         self._router = Router()
 
-        # request and response
-        self._request = Request()
-        self._response = Response(None)
+        # request and response, per thread or asyncio task.
+        self._context = contextvars.ContextVar(
+            "lunar.request_context", default=_RequestContext(Request(), Response(None))
+        )
 
         # template
         self.package_name = pkg_name
@@ -96,19 +146,21 @@ class Lunar(object):
             "\\", "\\\\"
         )  # '\u' escape
 
-        self.loader = Loader(os.sep.join([self.root_path, templates]))
+        self.loader = Loader(
+            os.sep.join([self.root_path, templates]), globals=self.template_globals()
+        )
 
         # static file
         self.static_folder = static
-        self.abspath = None
-        self.modified = None
-        self.static_url_cache = {}
+        #: (scheme, host, port, script name, filename) -> static file URL,
+        #: the URLs differ between the hosts an app is served under.
+        self.static_url_cache = LRUCache(_STATIC_URL_CAPACITY)
+        #: stat(), mime type, ETag... of the static files, checked again
+        #: at most every static_index.interval seconds.
+        self.static_index = StaticIndex()
 
         # session
-        self._session = self._request.cookies
-
-        # server handler
-        self._server_handler = None
+        self._session = self.request.cookies
 
         # debug
         self.debug = False
@@ -142,14 +194,32 @@ class Lunar(object):
 
         return wrapper
 
+    def add_converter(self, name, converter):
+        self._router.add_converter(name, converter)
+
+    def add_template_filter(self, name, fn):
+        self.loader.add_filter(name, fn)
+
     @property
     def session(self):
         return self._session
 
-    def run(self, server=WSGIRefServer, host="localhost", port=8000, debug=False):
+    def run(
+        self, server=WSGIRefServer, host="localhost", port=8000, debug=False, **options
+    ):
+        """Run the app with a ServerAdapter, given as an instance, a subclass
+        or a name of lunar.server.server_names like 'threading' or 'prefork'.
+        Extra options are given to the adapter, e.g. workers=4.
+        """
         self.debug = debug
+        if debug:
+            self.loader.auto_reload = True
+        if isinstance(server, str):
+            if server not in server_names:
+                raise RuntimeError("Unknown server %s." % server)
+            server = server_names[server]
         if isinstance(server, type) and issubclass(server, ServerAdapter):
-            server = server(host=host, port=port)
+            server = server(host=host, port=port, **options)
 
         if not isinstance(server, ServerAdapter):
             raise RuntimeError("Server must be a subclass of ServerAdapter.")
@@ -165,16 +235,29 @@ class Lunar(object):
         response.set_content_type("application/json")
         return response
 
+    def template_globals(self):
+        """Names templates see under their render context: the app module,
+        then this module. A live read-only view, nothing is copied per
+        render and names defined after the app are visible too.
+        """
+        app_module = sys.modules.get(self.package_name)
+        layers = [globals()]
+        if app_module is not None:
+            layers.insert(0, vars(app_module))
+        return MappingProxyType(ChainMap(*layers))
+
     def render(self, file, **context):
-        app_namespace = sys.modules[self.package_name].__dict__
-        context.update(globals())
-        context.update(app_namespace)
-        return self.loader.load(file).render(**context)
+        return self.loader.load(file).stream(**context)
 
     def not_found(self):
         response = Response(body="<h1>404 Not Found</h1>", code=404)
         return response
 
+    def method_not_allowed(self, allowed):
+        response = Response(body="<h1>405 Method Not Allowed</h1>", code=405)
+        response.headers["Allow"] = ", ".join(allowed)
+        return response
+
     def not_modified(self):
         response = Response("", code=304)
         # We don't need Content-Type here.
@@ -190,20 +273,24 @@ class Lunar(object):
         # URLs for static files are constructed according to
         # current wsgi environ(HTTP_HOST, SERVER_NAME, etc.)
         if fn == self.static_folder and filename:
-            if filename in self.static_url_cache.keys():
-                return self.static_url_cache[filename]
-            else:
-                url = self.construct_url(filename)
-                # Cache the URL
-                self.static_url_cache[filename] = url
-                return url
+            environ = self.request.headers
+            key = (
+                environ["wsgi.url_scheme"],
+                environ.get("HTTP_HOST") or environ["SERVER_NAME"],
+                environ.get("SERVER_PORT"),
+                environ.get("SCRIPT_NAME", ""),
+                filename,
+            )
+            return self.static_url_cache.get_or_compute(
+                key, lambda: self.construct_url(filename)
+            )
         # Router function URLs are given by the router.
         if kwargs:
             return self._router.url_for(fn, **kwargs)
         return self._router.url_for(fn)
 
     def construct_url(self, filename):
-        environ = self._request.headers
+        environ = self.request.headers
         url = environ["wsgi.url_scheme"] + "://"
         if environ.get("HTTP_HOST"):
             url += environ["HTTP_HOST"]
@@ -218,114 +305,270 @@ class Lunar(object):
                     url += ":" + environ["SERVER_PORT"]
 
         url += quote(environ.get("SCRIPT_NAME", ""))
-        if environ.get("QUERY_STRING"):
-            url += "?" + environ["QUERY_STRING"]
-
         url += "/" + "/".join([self.static_folder, filename])
         return url
 
     @property
     def request(self):
-        return self._request
+        return self._context.get().request
 
     @property
     def response(self):
-        return self._response
+        return self._context.get().response
 
-    def get_content_type(self):
-        fallback_content_type = "text/plain"
-        mime_type = mimetypes.guess_type(self.abspath)[0]
-        if mime_type:
-            return mime_type
-        else:
-            return fallback_content_type
-
-    def get_modified_time(self):
-        stats = os.stat(self.abspath)
+    # old names, still used by tests and user code.
+    _request = request
+    _response = response
 
-        last_modified_time = time.gmtime(stats.st_mtime)
-        return last_modified_time
+    def should_return_304(self, static_file):
+        if_none_match = self.request.if_none_match
+        if if_none_match:
+            etags = [e.strip() for e in if_none_match.split(",")]
+            return "*" in etags or static_file.etag in etags
 
-    def should_return_304(self):
-        if_modified_since_str = self._request.if_modified_since
+        if_modified_since_str = self.request.if_modified_since
         if if_modified_since_str:
-            if_modified_since_time = time.strptime(
-                if_modified_since_str, "%a, %d %b %Y %H:%M:%S %Z"
-            )
-            if if_modified_since_time >= self.modified:
+            # browsers send back the Last-Modified value, skip strptime.
+            if if_modified_since_str == static_file.last_modified:
+                return True
+            try:
+                if_modified_since_time = time.strptime(
+                    if_modified_since_str, "%a, %d %b %Y %H:%M:%S %Z"
+                )
+            except ValueError:
+                return False
+            if if_modified_since_time >= static_file.modified:
                 return True
         return False
 
     def is_static_file_request(self):
-        return self._request.path.lstrip("/").startswith(self.static_folder)
+        return self.request.path.lstrip("/").startswith(self.static_folder)
 
     def handle_static(self, path):
         response = Response(None)
 
         # This is the absolute path of a static file on the filesystem
-        self.abspath = self.root_path + path
-
-        if not os.path.exists(self.abspath) or not os.path.isfile(self.abspath):
+        static_file = self.static_index.get(self.root_path + path)
+        if static_file is None:
             return self.not_found()
 
-        content_type = self.get_content_type()
-        response.set_content_type(content_type)
-
-        self.modified = self.get_modified_time()
-
-        if self.should_return_304():
-            return self.not_modified()
-
-        if "Last-Modified" not in response.headers.keys():
-            last_modified_str = time.strftime(
-                "%a, %d %b %Y %H:%M:%S UTC", self.modified
-            )
-            response.headers["Last-Modified"] = last_modified_str
-
-        with open(self.abspath, "r") as f:
-            response.set_body(body=(f.read()))
+        static_file = static_file.variant(self.request.accept_encoding)
+        if static_file.variants or static_file.encoding:
+            response.headers["Vary"] = "Accept-Encoding"
+        if static_file.encoding:
+            response.headers["Content-Encoding"] = static_file.encoding
+
+        if self.should_return_304(static_file):
+            not_modified = self.not_modified()
+            not_modified.headers["ETag"] = static_file.etag
+            return not_modified
+
+        response.set_content_type(static_file.content_type)
+        last_modified_str = static_file.last_modified
+        response.headers["Last-Modified"] = last_modified_str
+        response.headers["ETag"] = static_file.etag
+        response.headers["Accept-Ranges"] = "bytes"
+
+        size = static_file.size
+        start, end = 0, size - 1
+        if_range = self.request.if_range
+        if not if_range or if_range in (last_modified_str, static_file.etag):
+            try:
+                r = parse_range(self.request.range, size)
+            except ValueError:
+                response = Response("", code=416)
+                response.headers["Content-Range"] = "bytes */%d" % size
+                return response
+            if r is not None:
+                start, end = r
+                response.set_status(206)
+                response.headers["Content-Range"] = "bytes %d-%d/%d" % (
+                    start,
+                    end,
+                    size,
+                )
+
+        # Binary mode, the file is streamed to the client by the server.
+        response.set_file(open(static_file.abspath, "rb"), start, end - start + 1)
         return response
 
-    def handle_router(self):
+    def match_handler(self):
+        """Return (handler, args) for the current request,
+        or a Response for 404 and 405.
+        """
         try:
-            handler, args = self._router.get(self._request.path, self._request.method)
+            request = self.request
+            handler, args = self._router.get(request.path, request.method)
         # No handler is found, we assume it's a 404.
         except TypeError:
             return self.not_found()
+        except MethodNotAllowed as e:
+            return self.method_not_allowed(e.allowed)
+        return handler, args or {}
 
-        if args:
-            r = handler(**args)
-        else:
-            r = handler()
+    def handle_router(self):
+        r = self.match_handler()
+        if isinstance(r, Response):
+            return r
+        handler, args = r
+        r = handler(**args)
+        # async def handler served by a WSGI server.
+        if inspect.iscoroutine(r):
+            r = asyncio.run(r)
         return r
 
+    def make_response(self, r):
+        """Bind the return value of a handler to the current response."""
+        ctx = self._context.get()
+        # Static files, 302, 304 and 404
+        if isinstance(r, Response):
+            ctx.response = r
+            return r
+
+        # Streamed templates
+        if inspect.isgenerator(r):
+            ctx.response.set_stream(r)
+            ctx.response.set_status(200)
+            return ctx.response
+
+        # Normal html
+        ctx.response.set_body(body=r)
+        ctx.response.set_status(200)
+        return ctx.response
+
     def __call__(self, environ, start_response):
-        self._response = Response(None)
-        self._request = Request(None)
-        self._server_handler = start_response
-        self._request.bind(environ)
+        # The context is left bound after the request, until the next
+        # request of the same thread or task replaces it.
+        ctx = _RequestContext(Request(environ), Response(None))
+        self._context.set(ctx)
 
         if self.is_static_file_request():
-            r = self.handle_static(self._request.path)
+            r = self.make_response(self.handle_static(ctx.request.path))
         else:
             try:
-                r = self.handle_router()
+                r = self.make_response(self.handle_router())
+                if r.stream is not None:
+                    r.set_stream(_started(r.stream))
             except Exception:
-                return LunarException(
-                    500, self._response, self._server_handler, self.debug
-                )()
+                return LunarException(500, ctx.response, start_response, self.debug)()
+
+        start_response(r.status, r.headerlist)
+        if r.file_body is not None:
+            return self.wsgi_file_body(environ, r.file_body)
+        if r.stream is not None:
+            return r.stream
+        return [r.body]
+
+    def wsgi_file_body(self, environ, file_body):
+        """Hand a streamed file to the server's wsgi.file_wrapper, which may
+        send it with os.sendfile, or fall back to reading it in blocks.
+        """
+        f = file_body.fileobj
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        # a file wrapper sends everything from the current position,
+        # only usable when the body runs up to the end of the file.
+        if file_wrapper is not None:
+            f.seek(0, os.SEEK_END)
+            if (
+                file_body.length is None
+                or file_body.start + file_body.length == f.tell()
+            ):
+                f.seek(file_body.start)
+                return file_wrapper(f, file_body.block_size)
+        return file_body
+
+    async def asgi(self, scope, receive, send):
+        """ASGI entry point of the app, e.g. for lunar.server.AsyncioServer.
+
+        'async def' handlers are awaited in the event loop, plain handlers
+        and static files run in the default executor of the loop, so they
+        don't block other requests.
+        """
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            raise RuntimeError("Unsupported ASGI scope type %s." % scope["type"])
+
+        body = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+
+        ctx = _RequestContext(
+            Request(environ_from_asgi(scope, b"".join(body))), Response(None)
+        )
+        self._context.set(ctx)
+        loop = asyncio.get_running_loop()
 
-        # Static files, 302, 304 and 404
-        if isinstance(r, Response):
-            self._response = r
-            self._server_handler(r.status, r.headerlist)
-            return [r.body]
-
-        # Normal html
-        self._response.set_body(body=r)
-        self._response.set_status(200)
-        start_response(self._response.status, self._response.headerlist)
-        return [self._response.body]
+        try:
+            if self.is_static_file_request():
+                r = await loop.run_in_executor(
+                    None,
+                    contextvars.copy_context().run,
+                    self.handle_static,
+                    ctx.request.path,
+                )
+            else:
+                r = self.match_handler()
+                if not isinstance(r, Response):
+                    handler, args = r
+                    if inspect.iscoroutinefunction(handler):
+                        r = await handler(**args)
+                    else:
+                        call = partial(handler, **args)
+                        r = await loop.run_in_executor(
+                            None, contextvars.copy_context().run, call
+                        )
+            r = self.make_response(r)
+            if r.stream is not None:
+                started = await loop.run_in_executor(
+                    None, contextvars.copy_context().run, _started, r.stream
+                )
+                r.set_stream(started)
+        except Exception:
+            r = LunarException(500, ctx.response, None, self.debug).build()
+
+        headers = [
+            (k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in r.headerlist
+        ]
+        stream = r.file_body if r.file_body is not None else r.stream
+        if stream is None:
+            headers.append((b"content-length", str(len(r.body)).encode("latin-1")))
+        await send(
+            {"type": "http.response.start", "status": r.status_code, "headers": headers}
+        )
+        if stream is None:
+            await send({"type": "http.response.body", "body": r.body})
+            return
+
+        # stream the file or the template, producing blocks in the executor.
+        blocks = iter(stream)
+        run = contextvars.copy_context().run
+        try:
+            while True:
+                data = await loop.run_in_executor(None, run, next, blocks, b"")
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": data,
+                        "more_body": bool(data),
+                    }
+                )
+                if not data:
+                    break
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
 
 
 """
@@ -1,8 +1,10 @@
 import sys
 import re
+import uuid
 
 from urllib.parse import parse_qs
 
+from .util import LRUCache
 
 rule_pattern = re.compile(
     r"""(?P<static>[^<]*) #static
@@ -18,6 +20,13 @@ rule_pattern = re.compile(
 
 valid_methods = ["GET", "POST", "DELETE" "PUT", "HEAD"]
 
+# Capacity of the cache of paths which matched no route (404) or
+# no route for the request method (405).
+_DEFAULT_MISSING_CAPACITY = 1024
+
+# Key of the method table for rules registered without methods.
+_ANY_METHOD = "*"
+
 
 def parse_rule(rule):
     pos = 0
@@ -42,12 +51,123 @@ class RouterException(Exception):
     pass
 
 
+class MethodNotAllowed(RouterException):
+    def __init__(self, method, allowed):
+        RouterException.__init__(
+            self, "Request method %s not allowed in this app." % method
+        )
+        self.allowed = allowed
+
+
+class BaseConverter(object):
+
+    """Converter for the typed variables of a rule, like <int:id>.
+
+    'regex' is the fragment the variable matches in the URL, 'to_python'
+    converts the matched text, raising ValueError rejects the match.
+    A converter whose regex can match '/' must set 'isolated' to False,
+    it will then consume the rest of the path.
+    """
+
+    regex = "[a-zA-Z0-9_]*"
+    isolated = True
+
+    def to_python(self, value):
+        return value
+
+
+class IntConverter(BaseConverter):
+    regex = r"\d+"
+
+    def to_python(self, value):
+        return int(value)
+
+
+class FloatConverter(BaseConverter):
+    regex = r"\d+(?:\.\d+)?"
+
+    def to_python(self, value):
+        return float(value)
+
+
+class PathConverter(BaseConverter):
+    regex = r"[^/].*?"
+    isolated = False
+
+
+class UUIDConverter(BaseConverter):
+    regex = (
+        r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+    )
+
+    def to_python(self, value):
+        return uuid.UUID(value)
+
+
+class SlugConverter(BaseConverter):
+    regex = r"[a-zA-Z0-9_]+(?:-[a-zA-Z0-9_]+)*"
+
+
+default_converters = {
+    "default": BaseConverter,
+    "string": BaseConverter,
+    "int": IntConverter,
+    "float": FloatConverter,
+    "path": PathConverter,
+    "uuid": UUIDConverter,
+    "slug": SlugConverter,
+}
+
+
+class _Segment(object):
+
+    """A dynamic piece of a rule in the dispatch trie.
+
+    Usually a single '/' separated segment, or the whole remaining path
+    when it holds a converter which is not isolated.
+    """
+
+    __slots__ = ("key", "regex", "converters", "tail")
+
+    def __init__(self, parts, converters):
+        regex_parts = []
+        key_parts = []
+        self.converters = {}
+        self.tail = False
+        for _is_dynamic, var in parts:
+            if _is_dynamic:
+                c = converters[var]
+                regex_parts.append("(?P<%s>%s)" % (var, c.regex))
+                key_parts.append("<%s:%s>" % (type(c).__name__, var))
+                self.converters[var] = c
+                self.tail = self.tail or not c.isolated
+            else:
+                regex_parts.append(re.escape(var))
+                key_parts.append(var)
+        self.key = u"".join(key_parts)
+        self.regex = re.compile(r"^%s$" % u"".join(regex_parts), re.UNICODE)
+
+    def match(self, text, args):
+        """Return args updated with the converted variables, or None."""
+        m = self.regex.match(text)
+        if m is None:
+            return None
+        args = dict(args)
+        try:
+            for var, value in m.groupdict().items():
+                args[var] = self.converters[var].to_python(value)
+        except ValueError:
+            return None
+        return args
+
+
 class Rule(object):
     """Route rule object
     """
 
-    def __init__(self, rule, methods):
+    def __init__(self, rule, methods, converters=None):
         self.rule = rule
+        self._converter_types = default_converters if converters is None else converters
         if methods is None:
             self.methods = None
         else:
@@ -60,8 +180,12 @@ class Rule(object):
 
         self._regex = None
         self._trace = []  # for building url
+        self._format = None  # precompiled url builder
+        self._segments = []  # for the dispatch trie
         self.variables = set()
+        self.converters = {}
         self.build_regex()
+        self.build_segments()
 
     def build_url(self, values=None):
         if values and len(self.variables) > len(values):
@@ -69,17 +193,12 @@ class Rule(object):
                 "Need %d argument to build the URL. Got %d"
                 % (len(self.variables), len(values))
             )
-        url_parts = []
-        for _is_dynamic, var in self._trace:
-            if _is_dynamic:
-                try:
-                    url_parts.append(str(values[var]))
-                except KeyError:
-                    raise RouterException("Need argument '%s' to build the URL." % var)
-            else:
-                url_parts.append(var)
-
-        return str(u"".join(url_parts))
+        if not self.variables:
+            return self._format
+        try:
+            return self._format.format_map(values or {})
+        except KeyError as e:
+            raise RouterException("Need argument '%s' to build the URL." % e.args[0])
 
     def build_regex(self):
         regex_parts = []
@@ -88,28 +207,177 @@ class Rule(object):
                 regex_parts.append(re.escape(_static))
                 self._trace.append((False, _static))
             elif _variable:
-                regex_parts.append("(?P<%s>%s)" % (_variable, "[a-zA-Z0-9_]*"))
+                try:
+                    converter = self._converter_types[_type or "default"]()
+                except KeyError:
+                    raise RouterException("Unknown converter type %s" % _type)
+                regex_parts.append("(?P<%s>%s)" % (_variable, converter.regex))
                 self._trace.append((True, _variable))
                 self.variables.add(_variable)
+                self.converters[_variable] = converter
         regex = r"^%s$" % (u"".join(regex_parts))
         self._regex = re.compile(regex, re.UNICODE)
 
+        if not self.variables:
+            self._format = u"".join(var for _, var in self._trace)
+            return
+        format_parts = []
+        for _is_dynamic, var in self._trace:
+            if _is_dynamic:
+                format_parts.append("{%s!s}" % var)
+            else:
+                format_parts.append(var.replace("{", "{{").replace("}", "}}"))
+        self._format = u"".join(format_parts)
+
+    def build_segments(self):
+        """Split the rule into '/' separated segments for the dispatch trie.
+
+        A segment without variables is kept as a plain string, a segment
+        with variables becomes a _Segment matching that segment only.
+        A converter which is not isolated (like path) swallows every
+        following segment into one _Segment matched against the rest of
+        the path.
+        """
+        segments = [[]]
+        for _is_dynamic, var in self._trace:
+            if _is_dynamic:
+                segments[-1].append((True, var))
+                continue
+            parts = var.split("/")
+            for i, part in enumerate(parts):
+                if i > 0:
+                    segments.append([])
+                if part:
+                    segments[-1].append((False, part))
+
+        for i, segment in enumerate(segments):
+            if all(not _is_dynamic for _is_dynamic, _ in segment):
+                self._segments.append((False, u"".join(v for _, v in segment)))
+                continue
+            if any(
+                _is_dynamic and not self.converters[var].isolated
+                for _is_dynamic, var in segment
+            ):
+                tail = []
+                for j, rest in enumerate(segments[i:]):
+                    if j > 0:
+                        tail.append((False, "/"))
+                    tail.extend(rest)
+                self._segments.append((True, _Segment(tail, self.converters)))
+                break
+            self._segments.append((True, _Segment(segment, self.converters)))
+
+
+class _Node(object):
+
+    """A node of the dispatch trie.
+
+    Static children are looked up by segment in a dict, dynamic children
+    are tried in registration order with their _Segment. The rules ending
+    at a node are indexed by request method.
+    """
+
+    __slots__ = ("static", "dynamic", "rules")
+
+    def __init__(self):
+        self.static = {}
+        self.dynamic = {}  # key -> (_Segment, _Node)
+        self.rules = {}  # method -> Rule
+
+    def child(self, _is_dynamic, segment):
+        if not _is_dynamic:
+            return self.static.setdefault(segment, _Node())
+        if segment.key not in self.dynamic:
+            self.dynamic[segment.key] = (segment, _Node())
+        return self.dynamic[segment.key][1]
+
+    def match(self, segments, pos, args):
+        """Depth first search for the node matching segments[pos:].
+
+        Static children win over dynamic ones, return (node, args) or
+        (None, None).
+        """
+        if pos == len(segments):
+            if self.rules:
+                return self, args
+            return None, None
+
+        segment = segments[pos]
+        node = self.static.get(segment)
+        if node is not None:
+            found, values = node.match(segments, pos + 1, args)
+            if found is not None:
+                return found, values
+
+        for dynamic, node in self.dynamic.values():
+            if dynamic.tail:
+                values = dynamic.match(u"/".join(segments[pos:]), args)
+                end = len(segments)
+            else:
+                values = dynamic.match(segment, args)
+                end = pos + 1
+            if values is None:
+                continue
+            found, values = node.match(segments, end, values)
+            if found is not None:
+                return found, values
+        return None, None
+
 
 class Router(object):
 
     """Router object for request routing.
+
+    Rules are compiled into a trie of path segments at registration time,
+    so dispatching costs O(path segments) whatever the number of routes.
+    Rules without variables are also kept in a dict keyed by the path,
+    a static hit is a single hash lookup, and every callable is indexed
+    to its first rule for url_for.
+
+    Typed variables like <int:id> are matched and converted by the
+    converters registered in Router.converters.
+
+    Lookups which end up in a 404 or a 405 are remembered in a bounded
+    LRU cache, so repeated probes of unknown paths cost a single lookup.
     """
 
-    def __init__(self):
+    def __init__(self, missing_capacity=_DEFAULT_MISSING_CAPACITY):
+        self.converters = dict(default_converters)
         self.rulesMap = {}
+        self._static = {}
+        self._reverse = {}
+        self._root = _Node()
+        self._missing = LRUCache(missing_capacity)
 
     def register(self, path, fn, methods):
         if not callable(fn):
             raise RouterException("Router only accept callable object.")
 
-        r = Rule(path, methods)
+        r = Rule(path, methods, self.converters)
         self.rulesMap[r] = fn
 
+        try:
+            self._reverse.setdefault(fn, r)
+        except TypeError:  # unhashable callable, url_for falls back to a scan
+            pass
+
+        node = self._root
+        for _is_dynamic, segment in r._segments:
+            node = node.child(_is_dynamic, segment)
+        for m in r.methods or (_ANY_METHOD,):
+            node.rules.setdefault(m, r)
+        if not r.variables:
+            self._static[path] = node.rules
+
+        # a new rule may match paths which were missing so far.
+        self._missing.clear()
+
+    def add_converter(self, name, converter):
+        """Register a BaseConverter subclass for rules like <name:var>."""
+        if not (isinstance(converter, type) and issubclass(converter, BaseConverter)):
+            raise RouterException("Converter must be a subclass of BaseConverter.")
+        self.converters[name] = converter
+
     def __call__(self, p, method="GET"):
         return self.get(p, method)
 
@@ -121,38 +389,46 @@ class Router(object):
         return f, args
 
     def _match_path(self, p, method="GET"):
-        for rule, fn in self.rulesMap.items():
-            r = rule._regex
-            m = r.match(p)
+        method = method.upper()
+        allowed = self._missing.get((method, p))
+        if allowed is not None:
+            if allowed:
+                raise MethodNotAllowed(method, allowed)
+            return None, None
 
-            if m is None:
-                continue
+        rules = self._static.get(p)
+        args = None
+        if rules is None:
+            node, args = self._root.match(p.split("/"), 0, {})
+            if node is None:
+                self._missing.set((method, p), ())
+                return None, None
+            rules = node.rules
 
-            if not method.upper() in rule.methods:
-                raise RouterException(
-                    "Request method %s not allowed in this app." % method
-                )
-            args = {}
-            for a in rule.variables:
-                args[a] = m.group(a)
-            if len(args) == 0:
-                args = None
-            return fn, args
-        return None, None
+        rule = rules.get(method) or rules.get(_ANY_METHOD)
+        if rule is None:
+            allowed = tuple(sorted(rules))
+            self._missing.set((method, p), allowed)
+            raise MethodNotAllowed(method, allowed)
+        return self.rulesMap[rule], args or None
 
     def url_for(self, fn, **kwargs):
         if not callable(fn):
             raise RouterException("router url_for method only accept callable object.")
-        for rule, v in self.rulesMap.items():
-            if v == fn:
-                if len(rule.variables) > 0:
-                    return rule.build_url(kwargs)
-                return rule.build_url()
-
-        raise RouterException("callable object doesn't matched any routing rule.")
+        try:
+            rule = self._reverse.get(fn)
+        except TypeError:
+            rule = next((r for r, v in self.rulesMap.items() if v == fn), None)
+        if rule is None:
+            raise RouterException("callable object doesn't matched any routing rule.")
+        return rule.build_url(kwargs)
 
     def all_callables(self):
         return self.rulesMap.values()
 
     def remove_all_routes(self):
         self.rulesMap.clear()
+        self._static.clear()
+        self._reverse.clear()
+        self._root = _Node()
+        self._missing.clear()
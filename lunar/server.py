@@ -7,6 +7,16 @@ instance and run applications using the run interface provided by ServerAdapter.
 So the server must implement the interface 'run' provided by ServerAdapter.
 """
 
+import asyncio
+import os
+import signal
+
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+from wsgiref.simple_server import make_server as _make_server
+
 
 class ServerAdapter(object):
     def __init__(self, host="127.0.0.1", port=8000):
@@ -19,13 +29,210 @@ class ServerAdapter(object):
     def run(self, app):
         pass
 
+    def shutdown(self):
+        """Stop a running server, may be called from another thread."""
+        pass
+
+
+class _SendfileServerHandler(ServerHandler):
+
+    """wsgiref ServerHandler sending wsgi.file_wrapper bodies with
+    socket.sendfile (os.sendfile where available), so static files go
+    from the page cache to the socket without a copy in Python.
+    """
+
+    def sendfile(self):
+        filelike = self.result.filelike
+        length = self.headers.get("Content-Length")
+        try:
+            filelike.fileno()
+        except (AttributeError, OSError):
+            return False
+        if length is None:
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        sent = self.request_handler.connection.sendfile(
+            filelike, filelike.tell(), int(length)
+        )
+        self.bytes_sent += sent
+        return True
+
+
+class _WSGIRequestHandler(WSGIRequestHandler):
+    def handle(self):
+        """Handle a single HTTP request, WSGIRequestHandler.handle
+        with _SendfileServerHandler.
+        """
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+
+        if not self.parse_request():  # An error code has been sent, just exit
+            return
+
+        handler = _SendfileServerHandler(
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=getattr(self.server, "multithread", False),
+            multiprocess=getattr(self.server, "multiprocess", False),
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+
+
+def make_server(host, port, app, server_class=WSGIServer):
+    return _make_server(
+        host, port, app, server_class=server_class, handler_class=_WSGIRequestHandler
+    )
+
 
 class WSGIRefServer(ServerAdapter):
     def run(self, app):
-        from wsgiref.simple_server import make_server
+        self.httpd = make_server(self.host, self.port, app)
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+
+class _PooledWSGIServer(ThreadingMixIn, WSGIServer):
+
+    """WSGIServer handling every connection in a bounded pool of threads.
+
+    Connections arriving while all the workers are busy wait in the pool
+    queue instead of spawning more threads.
+    """
+
+    workers = 16
+
+    # wsgi.multithread and wsgi.multiprocess of the requests.
+    multithread = True
+    multiprocess = False
+
+    def server_activate(self):
+        WSGIServer.server_activate(self)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        self._pool.shutdown(wait=True)
+
+
+class ThreadingServer(ServerAdapter):
+
+    """Multi-threaded server from the standard library,
+    requests are handled by a pool of 'workers' threads.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8000, workers=16):
+        ServerAdapter.__init__(self, host, port)
+        self.workers = workers
+
+    def run(self, app):
+        server_class = type(
+            "PooledWSGIServer", (_PooledWSGIServer,), {"workers": self.workers}
+        )
+        self.httpd = make_server(self.host, self.port, app, server_class=server_class)
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+
+class _PreforkWSGIServer(WSGIServer):
+
+    """WSGIServer whose socket is shared by the forked workers."""
+
+    multithread = False
+    multiprocess = True
+
+
+class PreforkServer(ServerAdapter):
+
+    """Pre-fork multi-process server from the standard library, unix only.
+
+    The master process binds the listening socket and forks 'workers'
+    processes which accept on it. A worker exits after 'max_requests'
+    requests (None for never), and the master forks a fresh one, so slow
+    leaks in the application can't grow forever.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8000, workers=None, max_requests=1000):
+        ServerAdapter.__init__(self, host, port)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.children = set()
+        self._running = False
+
+    def run(self, app):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("PreforkServer needs os.fork.")
 
-        httpd = make_server(self.host, self.port, app)
-        httpd.serve_forever()
+        self.httpd = make_server(
+            self.host, self.port, app, server_class=_PreforkWSGIServer
+        )
+        self._running = True
+        try:
+            while self._running:
+                while len(self.children) < self.workers:
+                    self._spawn()
+                try:
+                    pid, _ = os.wait()
+                except ChildProcessError:  # pragma: no cover
+                    continue
+                self.children.discard(pid)
+        finally:
+            self._running = False
+            self._kill_children()
+            self.httpd.server_close()
+
+    def shutdown(self):
+        self._running = False
+        self._kill_children()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        # worker process, never return to the master loop.
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            handled = 0
+            while self.max_requests is None or handled < self.max_requests:
+                self.httpd.handle_request()
+                handled += 1
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _kill_children(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (OSError, ChildProcessError):
+                pass
+            self.children.discard(pid)
 
 
 class TornadoServer(ServerAdapter):
@@ -57,3 +264,245 @@ class TwistedServer(ServerAdapter):
         server = server.Site(resource)
         reactor.listenTCP(port=self.port, factory=server, interface=self.host)
         reactor.run()
+
+
+class _BadRequest(Exception):
+    pass
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class AsyncioServer(ServerAdapter):
+
+    """HTTP/1.1 server on asyncio streams from the standard library.
+
+    It runs the ASGI entry point of the app (Lunar.asgi), or the app
+    itself when it is a plain ASGI callable. Connections are kept alive
+    and pipelined requests are answered in order. Sync handlers run in a
+    pool of 'workers' threads, the default executor of the loop.
+
+    Request bodies are read in memory, a request whose body is larger
+    than 'max_body_size' bytes is answered with a 413.
+    """
+
+    max_header_size = 65536
+    max_body_size = 10 * 1024 * 1024
+
+    def __init__(self, host="127.0.0.1", port=8000, workers=16, keep_alive=5):
+        ServerAdapter.__init__(self, host, port)
+        self.workers = workers
+        self.keep_alive = keep_alive
+        self.server_address = None
+        self._loop = None
+        self._stopped = None
+
+    def run(self, app):
+        asyncio.run(self._serve(getattr(app, "asgi", app)))
+
+    def shutdown(self):
+        self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _serve(self, app):
+        self._loop = asyncio.get_running_loop()
+        self._loop.set_default_executor(ThreadPoolExecutor(max_workers=self.workers))
+        self._stopped = asyncio.Event()
+
+        async def handle(reader, writer):
+            await self._handle_connection(app, reader, writer)
+
+        server = await asyncio.start_server(
+            handle, self.host, self.port, limit=self.max_header_size
+        )
+        self.server_address = server.sockets[0].getsockname()
+        async with server:
+            await self._stopped.wait()
+
+    async def _handle_connection(self, app, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), self.keep_alive
+                    )
+                except (
+                    asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError,
+                    asyncio.TimeoutError,
+                    ConnectionError,
+                ):
+                    break
+                try:
+                    scope, body = await self._read_request(head, reader, writer)
+                except (_BadRequest, ValueError, asyncio.IncompleteReadError):
+                    writer.write(
+                        b"HTTP/1.1 400 Bad Request\r\n"
+                        b"Content-Length: 0\r\nConnection: close\r\n\r\n"
+                    )
+                    break
+                except _BodyTooLarge:
+                    writer.write(
+                        b"HTTP/1.1 413 Payload Too Large\r\n"
+                        b"Content-Length: 0\r\nConnection: close\r\n\r\n"
+                    )
+                    break
+                if not await self._respond(app, scope, body, writer):
+                    break
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, head, reader, writer):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise _BadRequest()
+        if not version.startswith("HTTP/1."):
+            raise _BadRequest()
+
+        headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise _BadRequest()
+            headers.append((name.strip().lower(), value.strip()))
+        fields = dict(headers)
+
+        chunked = "chunked" in fields.get("transfer-encoding", "").lower()
+        length = 0 if chunked else int(fields.get("content-length", 0))
+        if length < 0:
+            raise _BadRequest()
+        if length > self.max_body_size:
+            raise _BodyTooLarge()
+
+        if fields.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        if chunked:
+            body = await self._read_chunked(reader)
+        else:
+            body = await reader.readexactly(length)
+
+        path, _, query = target.partition("?")
+        sockname = writer.get_extra_info("sockname")
+        peername = writer.get_extra_info("peername")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": version[5:],
+            "method": method.upper(),
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode("latin-1"),
+            "query_string": query.encode("latin-1"),
+            "root_path": "",
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+            "server": sockname[:2] if sockname else None,
+            "client": peername[:2] if peername else None,
+        }
+        return scope, body
+
+    async def _read_chunked(self, reader):
+        chunks, length = [], 0
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            length += size
+            if length > self.max_body_size:
+                raise _BodyTooLarge()
+            if size == 0:
+                # trailers, up to the empty line.
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def _respond(self, app, scope, body, writer):
+        """Run the app for one request, return True to keep the connection."""
+        fields = dict((k.lower(), v.lower()) for k, v in scope["headers"])
+        connection = fields.get(b"connection", b"")
+        if scope["http_version"] == "1.0":
+            keep_alive = connection == b"keep-alive"
+        else:
+            keep_alive = connection != b"close"
+        head_only = scope["method"] == "HEAD"
+        state = {
+            "started": False,
+            "chunked": False,
+            "done": False,
+            "keep_alive": keep_alive,
+        }
+        received = []
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {"type": "http.request", "body": body, "more_body": False}
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                names = set(k.lower() for k, _ in headers)
+                if b"content-length" not in names:
+                    if scope["http_version"] == "1.0":
+                        # the end of the body is the end of the connection.
+                        state["keep_alive"] = False
+                    else:
+                        state["chunked"] = True
+                        headers.append((b"transfer-encoding", b"chunked"))
+                headers.append(
+                    (b"connection", b"keep-alive" if state["keep_alive"] else b"close")
+                )
+                lines = [
+                    ("HTTP/1.1 %d %s\r\n" % (status, HTTPStatus(status).phrase)).encode(
+                        "latin-1"
+                    )
+                ]
+                lines.extend(b"%s: %s\r\n" % (k, v) for k, v in headers)
+                lines.append(b"\r\n")
+                writer.write(b"".join(lines))
+                state["started"] = True
+            elif message["type"] == "http.response.body":
+                data = message.get("body", b"")
+                more = message.get("more_body", False)
+                if not head_only:
+                    if state["chunked"]:
+                        if data:
+                            writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                        if not more:
+                            writer.write(b"0\r\n\r\n")
+                    else:
+                        writer.write(data)
+                await writer.drain()
+                state["done"] = not more
+
+        try:
+            await app(scope, receive, send)
+        except Exception:
+            if state["started"]:
+                return False
+            writer.write(
+                b"HTTP/1.1 500 Internal Server Error\r\n"
+                b"Content-Length: 0\r\nConnection: close\r\n\r\n"
+            )
+            return False
+        return state["done"] and state["keep_alive"]
+
+
+# Names accepted by Lunar.run for the server argument.
+server_names = {
+    "wsgiref": WSGIRefServer,
+    "threading": ThreadingServer,
+    "prefork": PreforkServer,
+    "asyncio": AsyncioServer,
+    "tornado": TornadoServer,
+    "twisted": TwistedServer,
+}
@@ -0,0 +1,158 @@
+"""
+Index of the static files served by lunar.
+
+Every static request used to stat the file, guess its mime type and
+format its Last-Modified date. StaticIndex keeps all of that per path,
+and only stats the file again once 'interval' seconds have passed since
+the last check.
+"""
+
+import mimetypes
+import os
+import time
+
+from stat import S_ISREG
+
+from .util import LRUCache
+
+# Capacity of the static file index.
+_DEFAULT_CAPACITY = 1024
+
+# Precompressed siblings, by preference: Content-Encoding -> file suffix.
+precompressed = (("br", ".br"), ("gzip", ".gz"))
+
+
+class StaticFile(object):
+
+    """Metadata of a static file, or of one of its precompressed siblings.
+    """
+
+    __slots__ = (
+        "abspath",
+        "size",
+        "mtime",
+        "content_type",
+        "etag",
+        "last_modified",
+        "modified",
+        "encoding",
+        "variants",
+    )
+
+    def __init__(self, abspath, stat, content_type, encoding=None):
+        self.abspath = abspath
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.content_type = content_type
+        self.encoding = encoding
+        self.etag = '"%x-%x%s"' % (
+            stat.st_mtime_ns,
+            stat.st_size,
+            "-" + encoding if encoding else "",
+        )
+        self.modified = time.gmtime(stat.st_mtime)
+        self.last_modified = time.strftime("%a, %d %b %Y %H:%M:%S UTC", self.modified)
+        # Content-Encoding -> StaticFile
+        self.variants = {}
+
+    def variant(self, accept_encoding):
+        """Return the best precompressed sibling for the Accept-Encoding
+        header, or self.
+        """
+        if not self.variants or not accept_encoding:
+            return self
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding, _ in precompressed:
+            if encoding in self.variants and encoding in accepted:
+                return self.variants[encoding]
+        return self
+
+
+def parse_accept_encoding(header):
+    """Return the set of codings accepted by an Accept-Encoding header."""
+    accepted = set()
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _stat(abspath):
+    try:
+        stat = os.stat(abspath)
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    return stat
+
+
+class StaticIndex(object):
+
+    """ path -> StaticFile cache with mtime revalidation.
+
+        A cached entry is trusted for 'interval' seconds, then the file is
+        stat-ed again and the entry rebuilt if its mtime or size changed.
+        Missing files are cached too, so repeated 404 probes don't hit
+        the filesystem either. An interval of 0 checks on every request.
+    """
+
+    def __init__(self, interval=2, capacity=_DEFAULT_CAPACITY):
+        self.interval = interval
+        self.cache = LRUCache(capacity=capacity)
+
+    def get(self, abspath):
+        """Return the StaticFile of abspath, None if it isn't a file."""
+        now = time.time()
+        entry = None
+        cached = self.cache.get(abspath)
+        if cached is not None:
+            checked, entry = cached
+            if now - checked < self.interval:
+                return entry
+
+        stat = _stat(abspath)
+        if stat is None:
+            entry = None
+        elif (
+            entry is None
+            or entry.mtime != stat.st_mtime_ns
+            or entry.size != stat.st_size
+            or not self._same_variants(entry)
+        ):
+            entry = self._build(abspath, stat)
+        self.cache.set(abspath, (now, entry))
+        return entry
+
+    def _same_variants(self, entry):
+        for encoding, suffix in precompressed:
+            variant = entry.variants.get(encoding)
+            stat = _stat(entry.abspath + suffix)
+            if variant is None and (stat is None or stat.st_mtime_ns < entry.mtime):
+                continue
+            if variant is None or stat is None or variant.mtime != stat.st_mtime_ns:
+                return False
+        return True
+
+    def _build(self, abspath, stat):
+        content_type = mimetypes.guess_type(abspath)[0] or "text/plain"
+        entry = StaticFile(abspath, stat, content_type)
+        for encoding, suffix in precompressed:
+            variant_stat = _stat(abspath + suffix)
+            # a stale sibling would serve an old version of the file.
+            if variant_stat is None or variant_stat.st_mtime_ns < stat.st_mtime_ns:
+                continue
+            entry.variants[encoding] = StaticFile(
+                abspath + suffix, variant_stat, content_type, encoding
+            )
+        return entry
+
+    def clear(self):
+        self.cache.clear()
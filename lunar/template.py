@@ -66,6 +66,21 @@
             >>> template.Template('{{ list(map(lambda x: x * 2, [1, 2, 3])) }}').render()
             '[2, 4, 6]'
 
+    filters, registered in Loader.filters and bound when the template
+    is compiled::
+
+            >>> template.Template("{{ ['lunar', 'web']|join(' ')|truncate(7) }}").render()
+            'luna...'
+
+    macros, functions of template code, which other templates import::
+
+            {% macro field(name, value='') %}
+            <input name="{{ name }}" value="{{ value }}">
+            {% endmacro %}
+            {% from 'forms.html' import field %}
+            {{ field('user') }}
+            {% call field('user') %}the body, caller() in the macro{% endcall %}
+
     and lastly, inheritance of template, extends and include::
 
             {% extends 'layout.html' %}
@@ -74,28 +89,96 @@
     Hacking with fun and joy.
 
 """
+import argparse
+import ast
+import builtins
+import datetime
+import glob
+import hashlib
+import io
+import itertools
+import marshal
 import os
 import re
+import sqlite3
+import symtable
 import sys
+import tempfile
+import threading
+import time
+import tokenize
 
-# REFACTORING TODO: [[[escape]]]
-# from .util import html_escape
+from importlib.util import MAGIC_NUMBER
 
-# TODO: escape options
-_DEFAULT_ESCAPE_OPTION = "maybe_escape_option"
+# Whether {{ }} output is html escaped by default.
+_DEFAULT_ESCAPE_OPTION = True
 
 
 # LRU Cache capacity:
 _DEFAULT_CACHECAPACITY = 128
 
+# Seconds between two mtime checks of a template when auto reloading.
+_DEFAULT_RELOAD_INTERVAL = 2
+
 # Inner variable of compiled template source code
 # which is a Python list, contain all the output
 # statement of Python code
 _DEFAULT_STDOUT = "_stdout"
 
-string_escape = "unicode_escape"
-
-from .util import _Stack, LRUCache
+# Name of the generator function the template is compiled to,
+# it takes the context and the output list and yields at the end
+# of every loop iteration, where the output may be flushed when
+# streaming.
+_DEFAULT_RENDER = "_render"
+
+# Arguments of the render function holding the context and the
+# globals, and local variable bound to the append method of the output.
+_DEFAULT_CONTEXT = "_ctx"
+_DEFAULT_GLOBALS = "_globals"
+_DEFAULT_APPEND = "_append"
+
+# Default argument of the render function holding util.escape, the
+# output of {{ }} is passed through it when escaping is on.
+_DEFAULT_ESCAPE = "_escape"
+
+# Size in bytes of the chunks yielded by Template.stream
+_DEFAULT_CHUNK_SIZE = 16384
+
+# Version of the generated code, part of the bytecode cache keys.
+# Bump it whenever the code generation changes.
+_BYTECODE_VERSION = 7
+
+# Argument of the render function holding the fragment cache
+# of {% cache %} tags, and prefix of the variables of those tags.
+_DEFAULT_FRAGMENTS = "_fragments"
+_CACHE_PREFIX = "_cache_"
+
+# Name of the filters in the render function, {{ v|join(',') }} is
+# compiled to _filter_join(v, ','), _filter_join a default argument
+# bound to the filter once, when the function is defined.
+_DEFAULT_FILTERS = "_filters"
+_FILTER_PREFIX = "_filter_"
+# Function of the caller body of a {% call %} tag, and the Markup
+# type, read by the macros to return their output.
+_DEFAULT_CALLER = "_caller"
+_DEFAULT_MARKUP = "_markup"
+
+# {% from 'forms.html' import field, button as b %}, a template path
+# in quotes, {% from os import path %} is still a Python import.
+_re_import = re.compile(
+    r"""(?P<quote>['"])(?P<filename>.+?)(?P=quote)\s+import\s+(?P<names>.+)\Z""", re.S
+)
+_re_filter = re.compile(r"\s*([A-Za-z_]\w*)\s*(?:\((.*)\))?\s*\Z", re.S)
+
+# Capacity of the in-process fragment cache.
+_DEFAULT_FRAGMENT_CAPACITY = 1024
+
+# Variables of the {% cache %} tags, numbered in the template, and
+# renumbered in the code of the included and extended templates, which
+# share the variables of one function.
+_re_cache_variable = re.compile(r"%s(key|value|stdout)(\d+)\Z" % _CACHE_PREFIX)
+
+from .util import _Stack, LRUCache, Markup, escape, html_escape
 
 
 class Scanner(object):
@@ -105,24 +188,35 @@ class Scanner(object):
 
     """
 
+    # statements which keep the whitespace of their line.
+    untrimmed_keyword = ["block"]
+
     def __init__(self, source):
         self.source = source
         self.cur = 0
         # regular expressions for token catching.
+        # a '-' right inside the braces, like {%- and -%}, strips the
+        # whitespace before or after the tag.
         self.re_token = re.compile(
             r"""
-        {{\s+(?P<var>.+?)\s+}} # variable
+        {{-?\s+(?P<var>.+?)\s+-?}} # variable
         | # or
-        {%\s+(?P<endblock>end(if|for|try|while|block))\s+%} # endblock
+        {%-?\s+(?P<endblock>end(if|for|try|while|block|cache|macro|call))\s+-?%} # endblock
         | # or
-        {%\s+(?P<statement>(?P<keyword>\w+)\s*(.*?))\s+%} # statement
+        {%-?\s+(?P<statement>(?P<keyword>\w+)\s*(.*?))\s+-?%} # statement
         """,
             re.VERBOSE,
         )
+        self.re_space = re.compile(r"\s*")
+        self.re_line_end = re.compile(r"[ \t]*(\r?\n|\Z)")
 
         # buffer for readed but not used token.
         self.buffer = []
 
+        # last position given to lineno, and its line.
+        self._line_pos = 0
+        self._line = 1
+
     @property
     def remain(self):
         """ Get remaining text which have not been processed.
@@ -137,24 +231,70 @@ class Scanner(object):
         and push the remain source text into buffer at the same time.
 
         """
-        p = self.re_token.search(self.remain)
+        # search from the cursor, no copy of the remaining source.
+        p = self.re_token.search(self.source, self.cur)
         if not p:
             return None
+        text, end = self._trim(p)
         # move forward.
-        s = p.start()
-        self.buffer.append(self.remain[:s].encode(string_escape))
-        self.cur += s + len(p.group())
+        self.buffer.append(text)
+        self.cur = end
 
         return p
 
+    def _trim(self, p):
+        """ Whitespace control, done once here instead of on every
+        rendered output.
+
+        A statement tag alone on its line drops the whole line, its
+        indentation and newline included. {%- and -%} strip all the
+        whitespace before and after the tag. Block tags keep their
+        line, the text around them is where the block goes.
+
+        Return the text before the token and where the next text starts.
+        """
+        tag = p.group()
+        text = self.source[self.cur : p.start()]
+        end = p.end()
+
+        if tag[2] == "-" or tag[-3] == "-":
+            if tag[2] == "-":
+                text = text.rstrip()
+            if tag[-3] == "-":
+                end = self.re_space.match(self.source, end).end()
+            return text, end
+
+        if p.group("var") or p.group("keyword") in self.untrimmed_keyword:
+            return text, end
+        if p.group("endblock") == "endblock":
+            return text, end
+
+        line_start = text.rfind("\n") + 1
+        if not line_start and self.cur > 0 and self.source[self.cur - 1] != "\n":
+            return text, end
+        if text[line_start:].strip(" \t"):
+            return text, end
+        line_end = self.re_line_end.match(self.source, end)
+        if line_end is None:
+            return text, end
+        return text[:line_start], line_end.end()
+
+    def lineno(self, pos):
+        """ Line number of a position in the source. Positions are
+        usually asked in order, only the text in between is counted.
+        """
+        if pos < self._line_pos:
+            self._line_pos, self._line = 0, 1
+        self._line += self.source.count("\n", self._line_pos, pos)
+        self._line_pos = pos
+        return self._line
+
     @property
     def buffer_before_token(self):
         """ Get the buffer text before token, and clear the buffer.
 
-            TODO: maybe a better solution for unicode or bytes processing.
-
         """
-        r = "".join(i for i in map(lambda x: x.decode("utf-8"), self.buffer))
+        r = "".join(self.buffer)
         self.buffer = []
         return r
 
@@ -191,10 +331,12 @@ class BaseNode(object):
 
     """
 
-    def __init__(self, text, indent, block):
+    def __init__(self, text, indent, block, lineno=None):
         self.text = text
         self.indent = indent
         self.block = block
+        # line of the tag in the template source
+        self.lineno = lineno
 
     def _write(self, text, wfile):
         if not self.block:
@@ -205,6 +347,10 @@ class BaseNode(object):
     def generate(self, wfile):
         raise NotImplementedError()
 
+    def check(self):
+        """ Raise SyntaxError if the code of the node alone is invalid. """
+        pass
+
 
 class KeyNode(BaseNode):
 
@@ -215,19 +361,32 @@ class KeyNode(BaseNode):
     def generate(self, wfile):
         self._write("".join([" " * self.indent, self.text, "\n"]), wfile)
 
+    def check(self):
+        keyword = self.text.split(None, 1)[0]
+        code = self.text
+        if keyword in ("else", "elif"):
+            code = "if 1:\n pass\n" + code
+        elif keyword in ("except", "finally"):
+            code = "try:\n pass\n" + code
+        if code.endswith(":"):
+            code += "\n pass"
+        compile(code, "<template>", "exec")
+
 
 class TextNode(BaseNode):
 
     """ Node for normal text
 
+        The text is written as a repr() literal, compile() keeps it as is
+        in the constants of the code object, whatever quotes, backslashes
+        or non-ASCII characters it holds.
+
     """
 
     def generate(self, wfile):
 
         self._write(
-            "".join(
-                [" " * self.indent, wfile.stdout, ".append('''", self.text, "''')\n"]
-            ),
+            "".join([" " * self.indent, wfile.append, "(", repr(self.text), ")\n"]),
             wfile,
         )
 
@@ -242,17 +401,38 @@ class VariableNode(BaseNode):
     def generate(self, wfile):
         self._write(
             "".join(
-                [" " * self.indent, wfile.stdout, ".append(str(", self.text, "))\n"]
+                [" " * self.indent, wfile.append, "(", wfile.escape, "("]
+                + [self.text, "))\n"]
             ),
             wfile,
         )
 
+    def check(self):
+        compile(self.text, "<template>", "eval")
+
 
 class SnippetNode(BaseNode):
+
+    """ Node for the intermediate code of an included template,
+    indented to the level of the include tag.
+
+    """
+
     def generate(self, wfile):
-        p = re.compile(r"\n")
-        self.text = re.compile(r"(\s+\n)+").sub("\n", "".join(self.text))
-        wfile.intermediate.append(p.sub("".join(["\n", " " * self.indent]), self.text))
+        lines = "".join(self.text).splitlines(True)
+        self._write("".join(" " * self.indent + line for line in lines), wfile)
+
+
+class MacroNode(SnippetNode):
+
+    """ Node for the function of a {% macro %} or of the body of a
+    {% call %}, 'text' is its code, 'nodes' the nodes of its body.
+
+    """
+
+    def __init__(self, text, indent, block, lineno=None, nodes=None):
+        super().__init__(text, indent, block, lineno)
+        self.nodes = nodes or []
 
 
 class ChildNode(BaseNode):
@@ -266,6 +446,9 @@ class ChildNode(BaseNode):
 class Writer(object):
     def __init__(self):
         self.stdout = _DEFAULT_STDOUT
+        self.append = _DEFAULT_APPEND
+        # function converting the {{ }} values to the output text.
+        self.escape = _DEFAULT_ESCAPE
         self.blocks = {}
         self.namespace = {}
 
@@ -285,15 +468,101 @@ class TemplateException(Exception):
     pass
 
 
+class TemplateSyntaxError(TemplateException):
+
+    """ Invalid Python code in a tag of a template.
+
+    'lineno' is the line of the tag, 'filename' the template file,
+    set by the Loader which loads it.
+    """
+
+    def __init__(self, msg, lineno=None, filename=None):
+        TemplateException.__init__(self, msg)
+        self.msg = msg
+        self.lineno = lineno
+        self.filename = filename
+
+    def __str__(self):
+        location = self.filename or "<template>"
+        if self.lineno:
+            location = "%s, line %d" % (location, self.lineno)
+        return "%s: %s" % (location, self.msg)
+
+
+class MemoryFragmentCache(object):
+
+    """ Store of the fragments rendered by {% cache key ttl %} tags,
+    a LRU cache in the process whose entries expire after their ttl.
+
+    Fragment stores only need get(key), returning None for a missing
+    or expired fragment, and set(key, value, ttl).
+    """
+
+    def __init__(self, capacity=_DEFAULT_FRAGMENT_CAPACITY):
+        self.cache = LRUCache(capacity)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(key, value, ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class SQLiteFragmentCache(threading.local):
+
+    """ Fragment store in a SQLite database, shared by the processes of
+    a pre-fork server. Each thread, and each forked process, uses a
+    connection of its own. Keys are stored as str().
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._connect()
+
+    def _connect(self):
+        if getattr(self, "pid", None) != os.getpid():
+            self.pid = os.getpid()
+            self.conn = sqlite3.connect(self.database, isolation_level=None)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS fragments "
+                "(key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+            )
+        return self.conn
+
+    def get(self, key):
+        row = (
+            self._connect()
+            .execute("SELECT value, expires FROM fragments WHERE key = ?", (str(key),))
+            .fetchone()
+        )
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        self._connect().execute(
+            "INSERT OR REPLACE INTO fragments VALUES (?, ?, ?)",
+            (str(key), value, expires),
+        )
+
+    def clear(self):
+        self._connect().execute("DELETE FROM fragments")
+
+
 class Template(object):
 
     """ Main class for compiled template instance.
 
     A initialized template instance will parse and compile
-    all the template source to Python intermediate code,
-    and instance function 'render' will use Python builtin function
-    'exec' to execute the intermediate code in Python
-    runtime.
+    all the template source to Python intermediate code, a
+    render function which binds the names it reads from the
+    context to local variables once, then runs the template
+    on them. Python builtin function 'exec' defines it once,
+    instance function 'render' just calls it.
 
     As function 'exec' own very strong power and the ability to
     execute all the python code in the runtime with given
@@ -307,7 +576,16 @@ class Template(object):
     leading_keyword = ["if", "try", "while", "for"]
     intermediate_keyword = ["else", "elif", "except", "finally"]
 
-    def __init__(self, source, path=None, escape_option=None):
+    # Template.stream output
+    chunk_size = _DEFAULT_CHUNK_SIZE
+    encoding = "utf-8"
+
+    # store of the {% cache %} fragments, shared by default.
+    fragments = MemoryFragmentCache()
+
+    def __init__(
+        self, source, path=None, escape_option=None, loader=None, filters=None
+    ):
 
         self.nodes = []
         self.scanner = Scanner(source)
@@ -319,13 +597,47 @@ class Template(object):
         # path for extends and include
         self.path = path
 
+        # Loader of the extended and included templates, the one which
+        # loads this template, so they are parsed once and cached.
+        self.loader = loader
+
+        # file the template was loaded from, set by Loader
+        self.filename = None
+
+        # files of the extended and included templates, recursively.
+        self.dependencies = []
+
+        # name -> code of the function, of the {% macro %} tags.
+        self.macros = {}
+        # macros and imports out of the blocks of an extending template,
+        # written ahead of the parent code.
+        self._hoisted = []
+        # numbers of the {% cache %} tags in the render function.
+        self._cache_numbers = itertools.count(1)
+
         # compiled intermediate code.
         self.intermediate = None
+        self._render = None
+
+        # read-only names under the render context, see Loader.globals
+        self.globals = {}
+
+        # html escape the {{ }} output, a Markup value is kept as is.
+        if escape_option is None:
+            escape_option = getattr(loader, "escape_option", _DEFAULT_ESCAPE_OPTION)
+        self.escape_option = escape_option
+        self.writer.escape = _DEFAULT_ESCAPE if escape_option else "str"
+
+        # name -> function of the {{ value|name }} filters
+        if filters is None:
+            filters = getattr(loader, "filters", default_filters)
+        self.filters = filters
 
         if source:
             self._parse()
             self.writer.generate(self.nodes)
             self.intermediate = self._compile()
+            self._render = self._function(self.intermediate)
 
     @property
     def intermediate_list(self):
@@ -334,6 +646,10 @@ class Template(object):
     def _parse(self):
         indent = 0
         in_block_stack = _Stack()
+        # (number, ttl) of the open {% cache %} tags
+        cache_stack = []
+        # the open {% macro %} and {% call %} tags, see _begin_macro
+        macro_stack = []
 
         # firstly, detect the extends tag.
         # if _ext, load the parents template
@@ -341,9 +657,10 @@ class Template(object):
         if _ext:
             # trim the quotes
             _ext = re.sub(r"\'|\"", "", _ext)
-            if self.path is None:
+            if self.path is None and self.loader is None:
                 raise TemplateException("Template path must set when extends tag used.")
-            self.parents = Loader(self.path).load(_ext)
+            self.parents = self._load(_ext)
+            self._depend(self.parents)
 
         while not self.scanner.empty:
             token = self.scanner.next_token
@@ -360,18 +677,43 @@ class Template(object):
             )
 
             variable, endblock, end, statement, keyword, suffix = token.groups()
+            lineno = self.scanner.lineno(token.start())
             # print(variable, endblock, end, statement, keyword, suffix)
             if variable:
-                self.nodes.append(VariableNode(variable, indent, in_block_stack.top()))
+                self.nodes.append(
+                    VariableNode(
+                        self._filter(variable), indent, in_block_stack.top(), lineno
+                    )
+                )
             elif endblock:
                 # enclose a block.
                 # pop it from block stack,
                 # if stack is None, raise Exception.
                 # indent = indent - 1 at the same time.
-                if end == "block" and in_block_stack.empty:
+                if end == "block" and in_block_stack.top() is None:
                     raise TemplateException("Invalid endblock tag.")
+                if end in ("macro", "call"):
+                    if not macro_stack or macro_stack[-1][0] != end:
+                        raise TemplateException("Invalid end%s tag." % end)
+                    in_block_stack.pop()
+                    indent = self._end_macro(macro_stack.pop(), in_block_stack.top())
+                    if end == "macro" and self._top_level(
+                        in_block_stack, macro_stack, indent
+                    ):
+                        self._hoisted.append(self.nodes[-1])
+                    continue
                 if end == "block":
                     in_block_stack.pop()
+                if end == "cache":
+                    if not cache_stack:
+                        raise TemplateException("Invalid endcache tag.")
+                    body, after = self._end_cache(cache_stack.pop())
+                    for line in body:
+                        self.nodes.append(KeyNode(line, indent, in_block_stack.top()))
+                    self.nodes.append(KeyNode(after, indent - 1, in_block_stack.top()))
+                # a macro is a function, not a generator.
+                if end in ("for", "while") and not macro_stack:
+                    self.nodes.append(KeyNode("yield", indent, in_block_stack.top()))
                 indent -= 1
             elif keyword:
                 if keyword == "include":
@@ -380,14 +722,50 @@ class Template(object):
                     # update it into namespace
                     suffix = re.sub(r"\'|\"", "", suffix)
 
-                    if self.path is None:
+                    if self.path is None and self.loader is None:
                         raise TemplateException(
                             "Template path must set when include tag used."
                         )
-                    c = Loader(self.path).load(suffix).intermediate_list
+                    child = self._load(suffix)
+                    self._depend(child)
+                    c = self._renumber(child.intermediate_list)
+                    if macro_stack:
+                        lines = "".join(c).splitlines(True)
+                        c = [line for line in lines if line.strip() != "yield"]
                     self.nodes.append(SnippetNode(c, indent, in_block_stack.top()))
                     continue
+                elif keyword in ("macro", "call"):
+                    macro_stack.append(
+                        self._begin_macro(keyword, suffix, indent, lineno)
+                    )
+                    # the body is a function of its own, out of any block.
+                    in_block_stack.push(None)
+                    indent = 1
+                    continue
+                elif keyword == "from" and _re_import.match(suffix):
+                    nodes = self._import(suffix, indent, lineno)
+                    for node in nodes:
+                        node.block = in_block_stack.top()
+                        self.nodes.append(node)
+                    if self._top_level(in_block_stack, macro_stack, indent):
+                        self._hoisted.extend(nodes)
+                    continue
+                elif keyword == "cache":
+                    n = next(self._cache_numbers)
+                    key, ttl = self._cache_args(suffix, lineno)
+                    for line in self._begin_cache(n, key):
+                        self.nodes.append(
+                            KeyNode(line, indent, in_block_stack.top(), lineno)
+                        )
+                    cache_stack.append((n, ttl))
+                    indent += 1
+                    self.nodes.append(
+                        KeyNode(self._swap_stdout(n), indent, in_block_stack.top())
+                    )
+                    continue
                 elif keyword == "block":
+                    if macro_stack:
+                        raise TemplateException("Block tag in a macro.")
                     if self.parents is None:
                         self.nodes.append(ChildNode(suffix))
 
@@ -398,7 +776,10 @@ class Template(object):
                     # perhaps unknown keyword?
                     self.nodes.append(
                         KeyNode(
-                            " ".join([keyword, suffix]), indent, in_block_stack.top()
+                            " ".join([keyword, suffix]),
+                            indent,
+                            in_block_stack.top(),
+                            lineno,
                         )
                     )  # pragma: no cover
                     continue
@@ -406,7 +787,10 @@ class Template(object):
                     indent -= 1
                 self.nodes.append(
                     KeyNode(
-                        " ".join([keyword, suffix, ":"]), indent, in_block_stack.top()
+                        " ".join([keyword, suffix, ":"]),
+                        indent,
+                        in_block_stack.top(),
+                        lineno,
                     )
                 )
                 indent += 1
@@ -415,25 +799,352 @@ class Template(object):
 
         if not in_block_stack.empty:
             raise TemplateException("Unmatched block")
+        if cache_stack:
+            raise TemplateException("Unmatched cache tag")
+        if macro_stack:
+            raise TemplateException("Unmatched %s tag" % macro_stack[-1][0])
+
+        self.nodes = self._fold(self.nodes)
+
+    def _begin_macro(self, keyword, suffix, indent, lineno):
+        """ Start the function of a {% macro name(args) %}, or of the body
+        of a {% call name(args) %}, which is passed to the macro as its
+        'caller' argument.
+
+        Return the state _end_macro needs, the nodes parsed so far are
+        kept there while the body is parsed in a list of its own.
+        """
+        try:
+            if keyword == "macro":
+                tree = ast.parse("def %s: pass" % suffix).body[0]
+            else:
+                tree = ast.parse(suffix, mode="eval").body
+        except SyntaxError as e:
+            raise TemplateSyntaxError(e.msg, lineno)
+        if keyword == "macro":
+            args = tree.args
+            names = [a.arg for a in getattr(args, "posonlyargs", [])]
+            names += [a.arg for a in args.args + args.kwonlyargs]
+            header = suffix
+            if "caller" not in names:
+                caller = "caller=None"
+                if args.vararg is None and not args.kwonlyargs:
+                    caller = "*, " + caller
+                header = _add_argument(suffix, caller, first=True)
+            header = "def %s:" % header
+            after = tree.name
+        elif isinstance(tree, ast.Call):
+            header = "def %s():" % _DEFAULT_CALLER
+            after = _add_argument(suffix, "caller=%s" % _DEFAULT_CALLER)
+        else:
+            raise TemplateSyntaxError("call tag needs a macro call", lineno)
+        try:
+            ast.parse(header + " pass")
+            ast.parse(after, mode="eval")
+        except SyntaxError:
+            raise TemplateSyntaxError("invalid %s tag %r" % (keyword, suffix), lineno)
+        saved = (keyword, header, after, self.nodes, indent, lineno)
+        stdout, append = self.writer.stdout, self.writer.append
+        self.nodes = [
+            KeyNode("%s = []; %s = %s.append" % (stdout, append, stdout), 1, None)
+        ]
+        return saved
+
+    def _end_macro(self, macro, block):
+        """ Close the function of a macro, or of a call body then call the
+        macro with it. Return the indent of the tag.
+        """
+        keyword, header, after, nodes, indent, lineno = macro
+        body = self.nodes
+        self.nodes = nodes
+        body.append(
+            KeyNode(
+                "return %s(''.join(%s))" % (_DEFAULT_MARKUP, self.writer.stdout),
+                1,
+                None,
+            )
+        )
+        body = self._fold(body)
+        writer = Writer()
+        writer.escape = self.writer.escape
+        writer.generate(body)
+        code = "".join([header, "\n"] + writer.intermediate)
+        self.nodes.append(MacroNode([code], indent, block, lineno, body))
+        if keyword == "macro":
+            self.macros[after] = code
+        else:
+            self.nodes.append(VariableNode(after, indent, block, lineno))
+        return indent
+
+    def _top_level(self, in_block_stack, macro_stack, indent):
+        """ Whether a tag of an extending template is out of any block,
+        where its code would be dropped with the rest of the template.
+        """
+        return (
+            self.parents is not None
+            and in_block_stack.top() is None
+            and not macro_stack
+            and indent == 0
+        )
+
+    def _import(self, suffix, indent, lineno):
+        """ Nodes of {% from 'forms.html' import field, button as b %},
+        the code of the macros, defined in this template too, with the
+        code of the macros of the same file they call.
+        """
+        match = _re_import.match(suffix)
+        if self.path is None and self.loader is None:
+            raise TemplateException("Template path must set when import tag used.")
+        template = self._load(match.group("filename"))
+        self._depend(template)
+        imported = []
+        for name in match.group("names").split(","):
+            name, _, alias = name.strip().partition(" as ")
+            name, alias = name.strip(), alias.strip()
+            if name not in template.macros:
+                raise TemplateSyntaxError(
+                    "no macro %s in %s" % (name, match.group("filename")), lineno
+                )
+            imported.append((name, alias))
+        needed, pending = set(), [name for name, _ in imported]
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                tree = ast.parse(template.macros[name])
+                pending.extend(
+                    node.id
+                    for node in ast.walk(tree)
+                    if isinstance(node, ast.Name) and node.id in template.macros
+                )
+        # in the order of the file, a macro may be a default argument.
+        nodes = [
+            SnippetNode([code], indent, None)
+            for name, code in template.macros.items()
+            if name in needed
+        ]
+        for name, alias in imported:
+            # imported macros are macros of this template for its importers.
+            self.macros[name] = template.macros[name]
+            if alias:
+                nodes.append(KeyNode("%s = %s" % (alias, name), indent, None, lineno))
+        return nodes
+
+    def _filter(self, expression):
+        """ Compile the filters of a {{ value|f(arg)|g }} expression to
+        calls, _filter_g(_filter_f(value, arg)).
+
+        The filters are the trailing '|' operands which are a registered
+        name, maybe called, the rest is the value, so {{ a | b }} is still
+        a bitwise or when b isn't a filter.
+        """
+        parts = _split_pipes(expression)
+        calls = []
+        while len(parts) > 1:
+            match = _re_filter.match(parts[-1])
+            if match is None or match.group(1) not in self.filters:
+                break
+            name, args = match.groups()
+            if args is not None and not _call_arguments(args):
+                break
+            calls.append((name, args))
+            parts.pop()
+        value = "|".join(parts)
+        for name, args in reversed(calls):
+            value = "%s%s(%s%s)" % (
+                _FILTER_PREFIX,
+                name,
+                value,
+                ", " + args if args and args.strip() else "",
+            )
+        return value
+
+    def _fold(self, nodes):
+        """ Merge adjacent text nodes of the same scope, drop empty ones,
+        so a run of literal text is a single append. Variables which are
+        Python literals, like {{ "&copy; 2015" }}, are text too.
+        """
+        folded = []
+        for node in nodes:
+            if type(node) is VariableNode:
+                try:
+                    value = ast.literal_eval(node.text.strip())
+                except (ValueError, SyntaxError, TypeError, MemoryError):
+                    value = node
+                if value is not node:
+                    value = escape(value) if self.escape_option else str(value)
+                    node = TextNode(value, node.indent, node.block)
+            if isinstance(node, TextNode):
+                if not node.text:
+                    continue
+                last = folded[-1] if folded else None
+                if (
+                    type(last) is TextNode
+                    and last.indent == node.indent
+                    and last.block == node.block
+                ):
+                    last.text += node.text
+                    continue
+            folded.append(node)
+        return folded
+
+    def _cache_args(self, suffix, lineno=None):
+        """ Split the arguments of {% cache key ttl %}, two expressions,
+        the ttl in seconds may be omitted for fragments which never expire.
+
+        A suffix which is one expression, like ('nav', uid) or 'a' + b,
+        is the key, else it is split before the first token out of any
+        bracket where both sides are expressions.
+        """
+        suffix = suffix.strip()
+        if _expression(suffix):
+            return suffix, "None"
+        try:
+            tokens = list(_top_level_tokens(suffix))
+        except (tokenize.TokenError, SyntaxError):
+            tokens = []
+        ignored = (tokenize.NEWLINE, tokenize.NL, tokenize.ENDMARKER)
+        for offset, token in tokens[1:]:
+            if token.type in ignored:
+                continue
+            key, ttl = suffix[:offset].strip(), suffix[offset:].strip()
+            if _expression(key) and _expression(ttl):
+                return key, ttl
+        raise TemplateSyntaxError("invalid cache tag %r" % suffix, lineno)
+
+    def _begin_cache(self, n, key):
+        """ {% cache %} looks the fragment up, and renders its body only
+        when the fragment is missing or expired.
+        """
+        name = "%s%%s%d" % (_CACHE_PREFIX, n)
+        return [
+            "%s = (%s)" % (name % "key", key),
+            "%s = %s.get(%s)" % (name % "value", _DEFAULT_FRAGMENTS, name % "key"),
+            "if %s is None:" % (name % "value"),
+        ]
+
+    def _renumber(self, code):
+        """ Lines of the code of another template, its {% cache %}
+        variables numbered after the ones of this template.
+        """
+        source = "".join(code)
+        offsets = [0]
+        for line in source.splitlines(True):
+            offsets.append(offsets[-1] + len(line))
+        numbers, parts, start = {}, [], 0
+        for token in tokenize.generate_tokens(io.StringIO(source).readline):
+            match = _re_cache_variable.match(token.string)
+            if token.type != tokenize.NAME or match is None:
+                continue
+            kind, n = match.groups()
+            if n not in numbers:
+                numbers[n] = next(self._cache_numbers)
+            row, col = token.start
+            parts.append(source[start : offsets[row - 1] + col])
+            parts.append("%s%s%d" % (_CACHE_PREFIX, kind, numbers[n]))
+            start = offsets[row - 1] + col + len(token.string)
+        parts.append(source[start:])
+        return "".join(parts).splitlines(True)
+
+    def _swap_stdout(self, n):
+        # the body renders to a list of its own, the output so far may
+        # be flushed by a stream meanwhile.
+        return "%s%s%d = %s; %s = []; %s = %s.append" % (
+            _CACHE_PREFIX,
+            "stdout",
+            n,
+            self.writer.stdout,
+            self.writer.stdout,
+            self.writer.append,
+            self.writer.stdout,
+        )
+
+    def _end_cache(self, cache):
+        n, ttl = cache
+        name = "%s%%s%d" % (_CACHE_PREFIX, n)
+        stdout, append = self.writer.stdout, self.writer.append
+        body = [
+            "%s = ''.join(%s)" % (name % "value", stdout),
+            "%s.set(%s, %s, %s)"
+            % (_DEFAULT_FRAGMENTS, name % "key", name % "value", ttl),
+            "%s = %s; %s = %s.append" % (stdout, name % "stdout", append, stdout),
+        ]
+        return body, "%s(%s)" % (append, name % "value")
+
+    @classmethod
+    def from_code(
+        cls,
+        code,
+        intermediate_list,
+        dependencies,
+        path=None,
+        escape_option=_DEFAULT_ESCAPE_OPTION,
+        filters=None,
+        macros=None,
+    ):
+        """ Rebuild a compiled template, e.g. from a BytecodeCache,
+        without parsing its source again.
+        """
+        t = cls(None, path=path, escape_option=escape_option, filters=filters)
+        t.writer.intermediate = intermediate_list
+        t.dependencies = dependencies
+        t.macros = macros or {}
+        t.intermediate = code
+        t._render = t._function(code)
+        return t
+
+    def _load(self, filename):
+        if self.loader is None:
+            self.loader = Loader(
+                self.path, escape_option=self.escape_option, filters=self.filters
+            )
+        return self.loader.load(filename)
+
+    def _depend(self, template):
+        for p in [template.filename] + template.dependencies:
+            if p not in self.dependencies:
+                self.dependencies.append(p)
 
     def render(self, *args, **context):
         for arg in args:
             context.update(arg)
 
-        # TODO: handler escape.
-        # if self.autoescape:
-        #    for (k, v) in context.items():
-        #       if isinstance(v, str):
-        #            context[k] = html_escape(v)
+        stdout = []
+        for _ in self._render(context, self.globals, stdout, self.fragments):
+            pass
+        return "".join(stdout)
+
+    def stream(self, *args, **context):
+        """ Render the template piece by piece.
+
+        A generator of byte chunks of about 'chunk_size', encoded with
+        'encoding'. The output is flushed at the end of loop iterations,
+        so a large table starts going out before it is fully rendered.
+        """
+        for arg in args:
+            context.update(arg)
 
-        context["_stdout"] = []
-        exec(self.intermediate, context)
-        return re.sub(r"(\s+\n)+", "\n", "".join(context[self.writer.stdout]))
+        stdout = []
+        pending = flushed = 0
+        for _ in self._render(context, self.globals, stdout, self.fragments):
+            pending += sum(map(len, stdout[flushed:]))
+            flushed = len(stdout)
+            if pending >= self.chunk_size:
+                yield "".join(stdout).encode(self.encoding)
+                del stdout[:]
+                pending = flushed = 0
+        if stdout:
+            yield "".join(stdout).encode(self.encoding)
 
     def _compile(self):
         # Process parent template files firstly.
         if self.parents:
-            self.writer.intermediate = self.parents.writer.intermediate
+            writer = Writer()
+            writer.escape = self.writer.escape
+            writer.generate(self._hoisted)
+            self.writer.intermediate = writer.intermediate + self._renumber(
+                self.parents.writer.intermediate
+            )
 
         # Update blocks
         pattern = re.compile(r"block%(?P<name>\w+)")
@@ -441,7 +1152,213 @@ class Template(object):
         for g in pattern.finditer(_t):
             if g.group("name") in self.writer.blocks.keys():
                 _t = _t.replace(g.group(), "".join(self.writer.blocks[g.group("name")]))
-        return compile(_t, "<string>", "exec")
+
+        # body of the render function, one more level of indent.
+        _t = "".join(" " + line for line in _t.splitlines(True))
+        head = "def %s(%s, %s, %s, %s, %s=%s):\n" % (
+            _DEFAULT_RENDER,
+            _DEFAULT_CONTEXT,
+            _DEFAULT_GLOBALS,
+            self.writer.stdout,
+            _DEFAULT_FRAGMENTS,
+            _DEFAULT_ESCAPE,
+            _DEFAULT_ESCAPE,
+        )
+        prologue = [" %s = %s.append\n" % (self.writer.append, self.writer.stdout)]
+        try:
+            for name in self._free_names(head + _t + " yield\n"):
+                if name.startswith(_FILTER_PREFIX):
+                    head = "%s, %s=%s[%r]):\n" % (
+                        head[: -len("):\n")],
+                        name,
+                        _DEFAULT_FILTERS,
+                        name[len(_FILTER_PREFIX) :],
+                    )
+                else:
+                    prologue.extend(" %s\n" % line for line in self._bind(name))
+            _t = "".join([head] + prologue + [_t, " yield\n"])
+            return compile(_t, "<string>", "exec")
+        except SyntaxError as e:
+            raise self._syntax_error(e)
+
+    def _syntax_error(self, e):
+        """ TemplateSyntaxError for a SyntaxError of the generated code,
+        at the line of the first tag whose code is invalid on its own.
+        """
+        nodes = list(reversed(self.nodes))
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(reversed(getattr(node, "nodes", ())))
+            try:
+                node.check()
+            except SyntaxError as error:
+                return TemplateSyntaxError(error.msg, node.lineno)
+        return TemplateSyntaxError(e.msg)
+
+    def _free_names(self, source):
+        """ Names the render function reads, which may come from the context.
+
+        Names only read in a lambda or a comprehension count too, the
+        prologue binding them turns them into closure variables.
+        """
+        internal = (
+            _DEFAULT_CONTEXT,
+            _DEFAULT_GLOBALS,
+            _DEFAULT_FRAGMENTS,
+            _DEFAULT_CALLER,
+            _DEFAULT_MARKUP,
+            self.writer.stdout,
+            self.writer.append,
+        )
+        function = symtable.symtable(source, "<string>", "exec").get_children()[0]
+        names = set(
+            s.get_name()
+            for s in function.get_symbols()
+            if s.is_referenced() and not s.is_parameter()
+        )
+        tables = function.get_children()
+        while tables:
+            t = tables.pop()
+            tables.extend(t.get_children())
+            names.update(
+                s.get_name()
+                for s in t.get_symbols()
+                if s.is_global() and s.is_referenced()
+            )
+        return sorted(
+            n for n in names if n not in internal and not n.startswith(_CACHE_PREFIX)
+        )
+
+    def _bind(self, name):
+        """ Prologue lines binding a name to a local variable, so that
+        the template reads it with LOAD_FAST.
+
+        The lookup goes through the context, then the globals, then the
+        builtins, a name found nowhere stays unbound and raises
+        UnboundLocalError, a NameError, when it is used.
+        """
+        lines = []
+        for layer in (_DEFAULT_CONTEXT, _DEFAULT_GLOBALS):
+            lines.append("%s %r in %s:" % ("elif" if lines else "if", name, layer))
+            lines.append(" %s = %s[%r]" % (name, layer, name))
+        if name in builtins.__dict__:
+            lines.append("else:")
+            lines.append(" %s = _builtins[%r]" % (name, name))
+        return lines
+
+    def _function(self, code):
+        namespace = {
+            "_builtins": builtins.__dict__,
+            _DEFAULT_ESCAPE: escape,
+            _DEFAULT_FILTERS: self.filters,
+            _DEFAULT_MARKUP: Markup,
+        }
+        exec(code, namespace)
+        return namespace[_DEFAULT_RENDER]
+
+
+class BytecodeCache(object):
+
+    """ A directory of compiled templates, so that a new process, like
+    a pre-forked worker, loads them without parsing and compiling.
+
+    An entry is keyed by the template path, a hash of its source, the
+    engine version and the bytecode magic number of the interpreter.
+    The files it extends or includes are checked by mtime and size
+    when it is loaded. Entries are written to a temporary file then
+    renamed, so a reader never sees a partial one.
+
+        loader = template.Loader("templates/", bytecode_cache="/tmp/lunar")
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def filename(
+        self, path, source, escape_option=_DEFAULT_ESCAPE_OPTION, filters=None
+    ):
+        # the names of the filters decide what '|' compiles to.
+        if filters is None:
+            filters = default_filters
+        key = hashlib.sha1()
+        for part in (
+            MAGIC_NUMBER,
+            str(_BYTECODE_VERSION).encode(),
+            str(bool(escape_option)).encode(),
+            " ".join(sorted(filters)).encode("utf-8"),
+            os.path.abspath(path).encode("utf-8"),
+            source.encode("utf-8"),
+        ):
+            key.update(part)
+            key.update(b"\0")
+        return os.path.join(self.directory, key.hexdigest() + ".cache")
+
+    def load(
+        self,
+        path,
+        source,
+        engine=Template,
+        root=None,
+        escape_option=_DEFAULT_ESCAPE_OPTION,
+        filters=None,
+    ):
+        """ Return the cached template of path, None if there is none
+        or a file it depends on changed.
+        """
+        try:
+            filename = self.filename(path, source, escape_option, filters)
+            with open(filename, "rb") as f:
+                intermediate_list, dependencies, code, macros = marshal.load(f)
+            for p, mtime, size in dependencies:
+                stat = os.stat(p)
+                if (stat.st_mtime_ns, stat.st_size) != (mtime, size):
+                    return None
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return engine.from_code(
+            code,
+            intermediate_list,
+            [p for p, _, _ in dependencies],
+            path=root,
+            escape_option=escape_option,
+            filters=filters,
+            macros=macros,
+        )
+
+    def dump(self, path, source, template):
+        try:
+            dependencies = []
+            for p in template.dependencies:
+                stat = os.stat(p)
+                dependencies.append((p, stat.st_mtime_ns, stat.st_size))
+            data = marshal.dumps(
+                (
+                    template.intermediate_list,
+                    dependencies,
+                    template.intermediate,
+                    template.macros,
+                )
+            )
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                filename = self.filename(
+                    path, source, template.escape_option, template.filters
+                )
+                os.replace(tmp, filename)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            # the cache only saves time, a template is still rendered.
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".cache"):
+                os.unlink(os.path.join(self.directory, name))
 
 
 class Loader(object):
@@ -455,6 +1372,26 @@ class Loader(object):
 
     Loader class use a LRU cache system to cache the recently used
     templates for performance consideration.
+
+    With 'escape_option', the default, the {{ }} output of the loaded
+    templates is html escaped, except Markup values, see unescape.
+
+    'filters' are the {{ value|name }} filters of the loaded templates,
+    the builtin ones by default, see add_filter.
+
+    'globals' is a mapping of names every loaded template can read
+    under its render context, looked up in place, never copied.
+
+    'bytecode_cache', a directory or a BytecodeCache, keeps compiled
+    templates on disk for the next processes.
+
+    'fragments' is the store of the {% cache %} tags of the loaded
+    templates, instead of the in-process Template.fragments.
+
+    With 'auto_reload', a cached template is checked again at most every
+    'reload_interval' seconds: if its file or one of the files it extends
+    or includes was modified, it is compiled again. A modified file also
+    drops every cached template depending on it.
     """
 
     def __init__(
@@ -463,19 +1400,51 @@ class Loader(object):
         engine=Template,
         escape_option=_DEFAULT_ESCAPE_OPTION,
         cache_capacity=_DEFAULT_CACHECAPACITY,
+        globals=None,
+        bytecode_cache=None,
+        auto_reload=False,
+        reload_interval=_DEFAULT_RELOAD_INTERVAL,
+        fragments=None,
+        filters=None,
     ):
         self.root = root
         self.engine = engine
+        self.globals = {} if globals is None else globals
+        if isinstance(bytecode_cache, str):
+            bytecode_cache = BytecodeCache(bytecode_cache)
+        self.bytecode_cache = bytecode_cache
+        self.fragments = fragments
+        self.filters = dict(default_filters if filters is None else filters)
+
+        self.auto_reload = auto_reload
+        self.reload_interval = reload_interval
+        # template path -> {file: mtime} of the template and its dependencies
+        self._mtimes = {}
+        # template path -> time of the last mtime check
+        self._checked = {}
+        # file -> paths of the templates extending or including it
+        self._dependents = {}
 
-        # TODO: escape option
         self.escape_option = escape_option
 
         self.cache = LRUCache(capacity=cache_capacity)
 
+    def add_filter(self, name, fn):
+        """ Register fn(value, *args) as the {{ value|name(*args) }} filter.
+
+        The filters are bound when a template is compiled, the templates
+        already compiled are dropped from the cache.
+        """
+        if not callable(fn):
+            raise TemplateException("Filter %s is not callable." % name)
+        self.filters[name] = fn
+        self.cache.clear()
+        self._mtimes.clear()
+        self._checked.clear()
+        self._dependents.clear()
+
     def update_engine(self, e, escape_option=_DEFAULT_ESCAPE_OPTION):
         self.engine = e
-
-        # TODO:
         self.escape_option = escape_option
 
     def load(self, filename):
@@ -483,31 +1452,265 @@ class Loader(object):
             self.root += os.sep
         p = "".join([self.root, filename])
 
-        # Use the cached template instance firstly
-        # TODO: add LRU tests.
-        cache_instance = self.cache.get(p)
-        if cache_instance != -1:
-            return cache_instance
+        # Threads missing the same template wait for a single compilation,
+        # a modified one is dropped from the cache by _modified and
+        # compiled again.
+        t = self.cache.get_or_compute(p, lambda: self._compile(p))
+        if self.auto_reload and self._modified(p):
+            t = self.cache.get_or_compute(p, lambda: self._compile(p))
+        return t
 
+    def _compile(self, p):
         if not os.path.isfile(p):
             raise TemplateException("Template file '%s' does not exist." % p)
 
         with open(p) as f:
-            self.cache.set(p, self.engine(f.read(), path=self.root))
-        return self.cache.get(p)
+            source = f.read()
+        t = None
+        if self.bytecode_cache is not None:
+            t = self.bytecode_cache.load(
+                p, source, self.engine, self.root, self.escape_option, self.filters
+            )
+        if t is None:
+            try:
+                t = self.engine(
+                    source,
+                    path=self.root,
+                    escape_option=self.escape_option,
+                    loader=self,
+                    filters=self.filters,
+                )
+            except TemplateSyntaxError as e:
+                if e.filename is None:
+                    e.filename = p
+                raise
+            if self.bytecode_cache is not None:
+                self.bytecode_cache.dump(p, source, t)
+        t.filename = p
+        t.globals = self.globals
+        if self.fragments is not None:
+            t.fragments = self.fragments
+        self._track(p, t)
+        return t
+
+    def precompile(self, pattern="**/*.html"):
+        """ Load every template under root matching the glob pattern, so
+        that requests find them compiled, in the cache and in the bytecode
+        cache if any.
+
+        Return the compiled filenames and a list of (filename, exception)
+        for the templates which failed, invalid or unreadable.
+        """
+        root = self.root or os.curdir
+        compiled, errors = [], []
+        for p in sorted(glob.glob(os.path.join(root, pattern), recursive=True)):
+            if not os.path.isfile(p):
+                continue
+            try:
+                self.load(os.path.relpath(p, root))
+            except (TemplateException, OSError, UnicodeDecodeError) as e:
+                errors.append((p, e))
+            else:
+                compiled.append(p)
+        return compiled, errors
 
+    def invalidate(self, filename):
+        """ Drop a template file, and the templates depending on it,
+        from the cache.
+        """
+        for p in [filename] + list(self._dependents.pop(filename, ())):
+            self.cache.delete(p)
+            self._mtimes.pop(p, None)
+            self._checked.pop(p, None)
+
+    def _track(self, p, t):
+        self._mtimes[p] = dict((f, _mtime(f)) for f in [p] + t.dependencies)
+        self._checked[p] = time.time()
+        for f in t.dependencies:
+            self._dependents.setdefault(f, set()).add(p)
+
+    def _modified(self, p):
+        now = time.time()
+        if now - self._checked.get(p, 0) < self.reload_interval:
+            return False
+        self._checked[p] = now
+        modified = [
+            f for f, mtime in self._mtimes.get(p, {}).items() if _mtime(f) != mtime
+        ]
+        for f in modified:
+            self.invalidate(f)
+        return bool(modified)
+
+
+def _top_level_tokens(expression):
+    """ (offset, token) of the tokens of an expression which are out of
+    any bracket. Raise tokenize.TokenError or SyntaxError if it can't be
+    tokenized.
+    """
+    offsets = [0]
+    for line in expression.splitlines(True):
+        offsets.append(offsets[-1] + len(line))
+    depth = 0
+    for token in tokenize.generate_tokens(io.StringIO(expression).readline):
+        if token.type == tokenize.OP and token.string in ")]}":
+            depth -= 1
+        if depth == 0:
+            row, col = token.start
+            yield offsets[row - 1] + col, token
+        if token.type == tokenize.OP and token.string in "([{":
+            depth += 1
+
+
+def _add_argument(source, argument, first=False):
+    """ Source of a def or a call with one more argument, last in its
+    first or last brackets, but before a **kwargs one.
+    """
+    brackets = [
+        offset
+        for offset, token in _top_level_tokens(source)
+        if token.type == tokenize.OP and token.string in ("(", ")")
+    ]
+    start, end = brackets[:2] if first else brackets[-2:]
+    start += 1
+    previous, after = None, ""
+    for offset, token in _top_level_tokens(source[start:end]):
+        if token.string == "**" and previous in (None, ","):
+            end, after = start + offset, ", "
+            break
+        if token.type not in (tokenize.NL, tokenize.COMMENT):
+            previous = token.string
+    before = source[start:end].rstrip()
+    if before:
+        before += " " if before.endswith(",") else ", "
+    return source[:start] + before + argument + after + source[end:]
+
+
+def _split_pipes(expression):
+    """ Split an expression on its '|' operators out of any bracket,
+    string or comment, [expression] if it can't be tokenized.
+    """
+    parts, start = [], 0
+    try:
+        for offset, token in _top_level_tokens(expression):
+            if token.type == tokenize.OP and token.string == "|":
+                parts.append(expression[start:offset])
+                start = offset + 1
+    except (tokenize.TokenError, SyntaxError):
+        return [expression]
+    parts.append(expression[start:])
+    return parts
+
+
+def _expression(text):
+    """Whether 'text' is a single Python expression."""
+    try:
+        ast.parse(text.strip(), mode="eval")
+    except SyntaxError:
+        return False
+    return True
+
+
+def _call_arguments(args):
+    """Whether 'args' are the arguments of one call, not 'a)(b'."""
+    try:
+        node = ast.parse("f(%s)" % args, mode="eval").body
+    except SyntaxError:
+        return False
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    """ Command line interface, compile the templates of a directory:
+
+        $ python -m lunar compile templates/ -b /tmp/lunar
+    """
+    parser = argparse.ArgumentParser(prog="python -m lunar")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser(
+        "compile", help="compile the templates of a directory"
+    )
+    command.add_argument("directory")
+    command.add_argument(
+        "-p", "--pattern", default="**/*.html", help="glob of the templates"
+    )
+    command.add_argument(
+        "-b", "--bytecode-cache", help="directory of the bytecode cache to fill"
+    )
+    args = parser.parse_args(argv)
 
-# TODO: remove this function
+    loader = Loader(args.directory, bytecode_cache=args.bytecode_cache)
+    compiled, errors = loader.precompile(args.pattern)
+    for filename, e in errors:
+        if isinstance(e, TemplateSyntaxError):
+            print(e, file=sys.stderr)
+        else:
+            print("%s: %s" % (filename, e), file=sys.stderr)
+    print("%d templates compiled, %d errors." % (len(compiled), len(errors)))
+    return 1 if errors else 0
 
 
 def unescape(s):
-    """ unescape html tokens.
+    """ unescape html tokens, the result is Markup so it is output as is.
         <p>{{ unescape(content) }}</p>
     """
-    return (
+    return Markup(
         s.replace("&amp;", "&")
         .replace("&lt;", "<")
         .replace("&gt;", ">")
         .replace("&quot;", '"')
         .replace("&#039;", "'")
     )
+
+
+def escape_filter(value):
+    """ {{ value|escape }}, the escaped value as Markup, so that it isn't
+    escaped a second time.
+    """
+    return Markup(escape(value))
+
+
+def truncate(value, length=255, end="..."):
+    """{{ value|truncate(80) }}, at most 'length' characters."""
+    value = str(value)
+    if len(value) <= length:
+        return value
+    return value[: max(length - len(end), 0)] + end
+
+
+def date(value, format="%Y-%m-%d"):
+    """ {{ value|date('%d %b %Y') }}, value a date, a datetime or
+    a timestamp.
+    """
+    if isinstance(value, (int, float)):
+        value = datetime.datetime.fromtimestamp(value)
+    return value.strftime(format)
+
+
+def join(value, separator=""):
+    """{{ value|join(', ') }}, the items of value as strings."""
+    return separator.join(map(str, value))
+
+
+def default(value, default_value="", boolean=False):
+    """ {{ value|default('-') }}, default_value when value is None,
+    or false with 'boolean'.
+    """
+    if value is None or (boolean and not value):
+        return default_value
+    return value
+
+
+default_filters = {
+    "escape": escape_filter,
+    "truncate": truncate,
+    "date": date,
+    "join": join,
+    "default": default,
+}
@@ -3,7 +3,7 @@
 import threading
 
 from collections import OrderedDict
-from time import time
+from time import monotonic, time
 from itertools import islice
 
 
@@ -17,10 +17,64 @@ def html_escape(s):
     )
 
 
+class Markup(str):
+
+    """ A string of html which must not be escaped again, like the
+        output of an escape or of a trusted helper.
+    """
+
+    __slots__ = ()
+
+    def __html__(self):
+        return self
+
+
+def escape(value):
+    """ Html escape the text of value, unless it is Markup or another
+        object with an __html__ method, which is trusted as it is.
+
+        The chained replaces measured faster than a str.translate table
+        on the short, mostly clean strings templates output.
+    """
+    if type(value) is str:
+        return html_escape(value)
+    if hasattr(value, "__html__"):
+        return value.__html__()
+    return html_escape(str(value))
+
+
 def sqlite_escape(s):
     return s.replace("'", "''")
 
 
+def parse_range(header, size):
+    """ Parse a single 'bytes=start-end' Range header for a body of 'size'
+        bytes, return (start, end) with end inclusive.
+
+        Return None when there is no usable range (missing, malformed or
+        multiple ranges), the whole body should be sent then. Raise
+        ValueError when the range can't be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, sep, end = header[6:].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not start:  # suffix range, the last 'end' bytes.
+            length = int(end)
+            if length <= 0:
+                raise ValueError("Unsatisfiable range %s" % header)
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise ValueError("Unsatisfiable range %s" % header)
+    return start, min(end, size - 1)
+
+
 class _Stack(threading.local):
     def __init__(self):
         self._Stack = []
@@ -51,34 +105,188 @@ class _Stack(threading.local):
         return len(self._Stack) == 0
 
 
-class LRUCache(object):
+# Caches of at least this many entries per stripe are split in stripes.
+_STRIPE_SIZE = 64
+_MAX_STRIPES = 16
 
-    """ Simple LRU cache for template instance caching.
 
-        in fact, the OrderedDict in collections module or
-        @functools.lru_cache is working well too.
+class _Flight(object):
 
+    """ A value being computed by get_or_compute, other threads asking
+        for the same key wait for it instead of computing it again.
     """
 
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _Stripe(object):
     def __init__(self, capacity):
         self.capacity = capacity
+        self.weight = 0
+        self.lock = threading.Lock()
+        # key -> (value, weight, expires)
         self.cache = OrderedDict()
+        self.flights = {}
+        self.hits = self.misses = self.evictions = 0
 
-    def get(self, key):
-        """ Return -1 if catched KeyError exception.
 
+class LRUCache(object):
+
+    """ Thread safe LRU cache, for template instances, static files and
+        missing routes.
+
+        The keys are spread over lock striped segments, each with its
+        own share of the capacity, so threads working on different keys
+        rarely wait for each other. Small caches, and weighted caches
+        unless 'stripes' is given, have a single segment and evict in
+        exact LRU order: a segment refuses the values weighing more than
+        its share.
+
+        The capacity is a total weight, every entry weighs weigh(value),
+        1 if weigh is None. An entry may expire after ttl seconds, the
+        default ttl of the cache or the one given to set.
+
+        hits, misses and evictions count the lookups, to size the cache
+        from real numbers.
+    """
+
+    def __init__(self, capacity, ttl=None, weigh=None, stripes=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.weigh = weigh
+        if stripes is None and weigh is not None:
+            stripes = 1
+        elif stripes is None:
+            stripes = min(max(int(capacity) // _STRIPE_SIZE, 1), _MAX_STRIPES)
+        self._stripes = [_Stripe(capacity / stripes) for _ in range(stripes)]
+
+    def _stripe(self, key):
+        if len(self._stripes) == 1:
+            return self._stripes[0]
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _lookup(self, stripe, key):
+        """Return the entry of key or None, the stripe lock is held."""
+        entry = stripe.cache.get(key)
+        if entry is not None:
+            if entry[2] is not None and entry[2] <= monotonic():
+                del stripe.cache[key]
+                stripe.weight -= entry[1]
+                entry = None
+            else:
+                stripe.cache.move_to_end(key)
+        if entry is None:
+            stripe.misses += 1
+        else:
+            stripe.hits += 1
+        return entry
+
+    def _store(self, stripe, key, value, ttl):
+        """Insert value and evict the least recently used entries."""
+        weight = 1 if self.weigh is None else self.weigh(value)
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else monotonic() + ttl
+        old = stripe.cache.pop(key, None)
+        if old is not None:
+            stripe.weight -= old[1]
+        if weight > stripe.capacity:  # would evict everything, don't keep it.
+            return
+        while stripe.cache and stripe.weight + weight > stripe.capacity:
+            stripe.weight -= stripe.cache.popitem(last=False)[1][1]
+            stripe.evictions += 1
+        stripe.cache[key] = (value, weight, expires)
+        stripe.weight += weight
+
+    def get(self, key, default=None):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = self._lookup(stripe, key)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            self._store(stripe, key, value, ttl)
+
+    def delete(self, key):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = stripe.cache.pop(key, None)
+            if entry is not None:
+                stripe.weight -= entry[1]
+
+    def get_or_compute(self, key, compute, ttl=None):
+        """ Return the value of key, calling compute() to make it on a miss.
+
+            Concurrent misses of a key share a single call of compute, the
+            other threads wait for its value, or its exception.
         """
-        try:
-            value = self.cache.pop(key)
-            self.cache[key] = value
-            return value
-        except KeyError:
-            return -1
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = self._lookup(stripe, key)
+            if entry is not None:
+                return entry[0]
+            flight = stripe.flights.get(key)
+            owner = flight is None
+            if owner:
+                flight = stripe.flights[key] = _Flight()
+
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
 
-    def set(self, key, value):
         try:
-            self.cache.pop(key)
-        except KeyError:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
-        self.cache[key] = value
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        else:
+            with stripe.lock:
+                self._store(stripe, key, flight.value, ttl)
+        finally:
+            with stripe.lock:
+                del stripe.flights[key]
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.cache.clear()
+                stripe.weight = 0
+
+    def __len__(self):
+        return sum(len(stripe.cache) for stripe in self._stripes)
+
+    def __contains__(self, key):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = stripe.cache.get(key)
+            return entry is not None and (entry[2] is None or entry[2] > monotonic())
+
+    @property
+    def hits(self):
+        return sum(stripe.hits for stripe in self._stripes)
+
+    @property
+    def misses(self):
+        return sum(stripe.misses for stripe in self._stripes)
+
+    @property
+    def evictions(self):
+        return sum(stripe.evictions for stripe in self._stripes)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self),
+            "capacity": self.capacity,
+        }
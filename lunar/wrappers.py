@@ -1,10 +1,13 @@
 import sys
 import cgi
-import threading
 
-from collections import MutableMapping
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # pragma: no cover
+    from collections import MutableMapping
 
 import http.client as httplib
+from io import BytesIO
 from http.cookies import SimpleCookie
 from urllib.parse import parse_qs
 
@@ -63,10 +66,69 @@ class HttpHeaders(MutableMapping):
         return "-".join([w.capitalize() for w in key.split("-")])
 
 
-class BaseObject(threading.local):
+def environ_from_asgi(scope, body=b""):
+    """Build a WSGI environ from an ASGI http scope and the request body."""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_TYPE":
+            environ[key] = value
+        elif key != "CONTENT_LENGTH":
+            key = "HTTP_" + key
+            if key in environ:
+                value = environ[key] + "," + value
+            environ[key] = value
+    return environ
+
+
+class FileBody(object):
+
+    """Iterable over 'length' bytes of a binary file from 'start',
+    the body of a streamed file response. The file is closed by close(),
+    which WSGI servers call once the response is sent.
+    """
+
+    def __init__(self, fileobj, start=0, length=None, block_size=65536):
+        self.fileobj = fileobj
+        self.start = start
+        self.length = length
+        self.block_size = block_size
+
+    def __iter__(self):
+        self.fileobj.seek(self.start)
+        remaining = self.length
+        while remaining is None or remaining > 0:
+            size = self.block_size
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            data = self.fileobj.read(size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class BaseObject(object):
 
     """Base class for request and response.
-    Provide a thread safe space.
+    A new instance is created for each request, lunar.Lunar keeps the
+    current ones in a per thread / per task context.
     """
 
     pass
@@ -131,6 +193,22 @@ class Request(BaseObject):
     def if_modified_since(self):
         return self.environ.get("HTTP_IF_MODIFIED_SINCE", "")
 
+    @property
+    def if_none_match(self):
+        return self.environ.get("HTTP_IF_NONE_MATCH", "")
+
+    @property
+    def accept_encoding(self):
+        return self.environ.get("HTTP_ACCEPT_ENCODING", "")
+
+    @property
+    def range(self):
+        return self.environ.get("HTTP_RANGE", "")
+
+    @property
+    def if_range(self):
+        return self.environ.get("HTTP_IF_RANGE", "")
+
 
 class Response(BaseObject):
     def __init__(self, body, code=200, content_type="text/html"):
@@ -141,6 +219,8 @@ class Response(BaseObject):
 
         # body
         self._body = None
+        self.file_body = None
+        self.stream = None
         self.set_body(body)
 
     @property
@@ -158,6 +238,10 @@ class Response(BaseObject):
     def status(self):
         return " ".join([str(self._status), httplib.responses.get(self._status)])
 
+    @property
+    def status_code(self):
+        return self._status
+
     def set_status(self, s):
         self._status = s
 
@@ -170,11 +254,24 @@ class Response(BaseObject):
         return self._body
 
     def set_body(self, body):
+        self.stream = None
         self._body = str(body)
         # Python 3 bytes hack
         if sys.version > "3":
             self._body = bytes(self._body, "utf-8")
 
+    def set_file(self, fileobj, start=0, length=None):
+        """Stream 'length' bytes of a binary file from 'start' as the body."""
+        self._body = b""
+        self.file_body = FileBody(fileobj, start, length)
+        if length is not None:
+            self.headers["Content-Length"] = str(length)
+
+    def set_stream(self, iterable):
+        """Send the byte chunks of 'iterable' as the body, as they come."""
+        self._body = b""
+        self.stream = iterable
+
     def get_content_type(self):
         return self.headers["Content-Type"]
 
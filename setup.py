@@ -21,4 +21,5 @@ setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
     ],
     long_description=long_description,
+    python_requires=">=3.7",
 )
@@ -1,6 +1,9 @@
+import asyncio
+import inspect
 import os
 import sys
 import time
+import threading
 import unittest
 
 if sys.version < "3":
@@ -14,6 +17,7 @@ else:
 
 from lunar.lunar import Lunar, LunarException, _Stack
 from lunar.router import RouterException
+from lunar.template import Template, unescape
 
 
 def start_response(status, headerlist):
@@ -28,6 +32,7 @@ app = Lunar("__main__")
 
 dirname, filename = os.path.split(os.path.abspath(__file__))
 app.root_path = dirname
+app.loader.root = os.path.join(dirname, "templates")
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -60,7 +65,8 @@ def sync_args(id):
 
 @app.route("/template")
 def template():
-    return app.render("index.html")
+    # the app module is __main__ only when run as a script.
+    return app.render("index.html", app=app)
 
 
 @app.route("/url_for_with_args")
@@ -114,6 +120,18 @@ def handler_exception():
     raise RuntimeError
 
 
+@app.route("/template_error")
+def template_error():
+    return Template("<p>{{ missing_name }}</p>").stream()
+
+
+@app.route("/echo/<int:n>")
+def echo(n):
+    time.sleep(0.001)  # give the other threads a chance to run.
+    app.response.headers["X-Echo"] = str(n)
+    return "%d:%s:%s" % (n, app.request.args["q"], app.request.path)
+
+
 class StackTest(unittest.TestCase):
     def setUp(self):
         self.stack = _Stack()
@@ -157,12 +175,25 @@ class AppTest(unittest.TestCase):
         r = app(env, start_response)
         url = app.url_for("static", "style.css")
         self.assertEqual(
-            app.static_url_cache, {"style.css": "http://localhost/static/style.css"}
+            app.static_url_cache.get(("http", "localhost", "80", "", "style.css")),
+            "http://localhost/static/style.css",
         )
         self.assertEqual(
             app.url_for("static", "style.css"), "http://localhost/static/style.css"
         )
 
+    def test_static_url_for_cache_per_host(self):
+        for host in ("a.example", "b.example"):
+            env = {
+                "HTTP_HOST": host,
+                "wsgi.url_scheme": "http",
+                "SERVER_PORT": "80",
+            }
+            app(env, start_response)
+            self.assertEqual(
+                app.url_for("static", "style.css"), "http://%s/static/style.css" % host,
+            )
+
     def test_static_url_for_with_http_standard_port(self):
         env = {
             "HTTP_HOST": "localhost",
@@ -229,6 +260,18 @@ class AppTest(unittest.TestCase):
         r = app(env, start_response)
         self.assertEqual(app._response.status, "404 Not Found")
 
+    def test_method_not_allowed(self):
+        env = {
+            "HTTP_HOST": "localhost",
+            "wsgi.url_scheme": "http",
+            "SERVER_PORT": "80",
+            "PATH_INFO": "/template",
+            "REQUEST_METHOD": "POST",
+        }
+        r = app(env, start_response)
+        self.assertEqual(app._response.status, "405 Method Not Allowed")
+        self.assertEqual(app._response.headers["Allow"], "GET, HEAD")
+
     def test_redirect(self):
         env = {
             "HTTP_HOST": "localhost",
@@ -322,6 +365,76 @@ class AppTest(unittest.TestCase):
         self.assertEqual(app._response.status, "200 OK")
         self.assertEqual(app._response.content_type, "text/css")
 
+    def test_handle_static_streamed(self):
+        env = {"PATH_INFO": "/static/style.css"}
+        body = b"".join(app(env, start_response))
+        with open(os.path.join(dirname, "static", "style.css"), "rb") as f:
+            content = f.read()
+        self.assertEqual(body, content)
+        self.assertEqual(app._response.headers["Content-Length"], str(len(content)))
+        self.assertEqual(app._response.headers["Accept-Ranges"], "bytes")
+
+    def test_handle_static_with_file_wrapper(self):
+        wrapped = []
+
+        def file_wrapper(f, block_size):
+            wrapped.append(f)
+            return iter(lambda: f.read(block_size), b"")
+
+        env = {
+            "PATH_INFO": "/static/style.css",
+            "wsgi.file_wrapper": file_wrapper,
+            "HTTP_RANGE": "bytes=2-",
+        }
+        body = b"".join(app(env, start_response))
+        self.assertEqual(len(wrapped), 1)
+        with open(os.path.join(dirname, "static", "style.css"), "rb") as f:
+            self.assertEqual(body, f.read()[2:])
+
+    def test_handle_static_range(self):
+        with open(os.path.join(dirname, "static", "style.css"), "rb") as f:
+            content = f.read()
+        size = len(content)
+
+        env = {"PATH_INFO": "/static/style.css", "HTTP_RANGE": "bytes=1-4"}
+        body = b"".join(app(env, start_response))
+        self.assertEqual(app._response.status, "206 Partial Content")
+        self.assertEqual(body, content[1:5])
+        self.assertEqual(app._response.headers["Content-Length"], "4")
+        self.assertEqual(app._response.headers["Content-Range"], "bytes 1-4/%d" % size)
+
+        env = {"PATH_INFO": "/static/style.css", "HTTP_RANGE": "bytes=-3"}
+        body = b"".join(app(env, start_response))
+        self.assertEqual(body, content[-3:])
+
+        env = {"PATH_INFO": "/static/style.css", "HTTP_RANGE": "bytes=%d-" % size}
+        body = b"".join(app(env, start_response))
+        self.assertEqual(app._response.status, "416 Requested Range Not Satisfiable")
+        self.assertEqual(app._response.headers["Content-Range"], "bytes */%d" % size)
+
+    def test_handle_static_if_range_mismatch(self):
+        env = {
+            "PATH_INFO": "/static/style.css",
+            "HTTP_RANGE": "bytes=1-4",
+            "HTTP_IF_RANGE": "Thu, 01 Jan 1970 00:00:00 UTC",
+        }
+        b"".join(app(env, start_response))
+        self.assertEqual(app._response.status, "200 OK")
+
+    def test_handle_static_etag(self):
+        env = {"PATH_INFO": "/static/style.css"}
+        app(env, start_response)
+        etag = app._response.headers["ETag"]
+
+        env = {"PATH_INFO": "/static/style.css", "HTTP_IF_NONE_MATCH": etag}
+        app(env, start_response)
+        self.assertEqual(app._response.status, "304 Not Modified")
+        self.assertEqual(app._response.headers["ETag"], etag)
+
+        env = {"PATH_INFO": "/static/style.css", "HTTP_IF_NONE_MATCH": '"other"'}
+        app(env, start_response)
+        self.assertEqual(app._response.status, "200 OK")
+
     def test_handle_static_not_found(self):
         env = {
             "HTTP_HOST": "localhost",
@@ -331,3 +444,156 @@ class AppTest(unittest.TestCase):
         }
         r = app(env, start_response)
         self.assertEqual(app._response.status, "404 Not Found")
+
+    def test_template_globals(self):
+        g = app.template_globals()
+        self.assertIs(g["unescape"], unescape)
+        with self.assertRaises(TypeError):
+            g["unescape"] = None
+        self.assertIs(app.loader.globals["Lunar"], Lunar)
+
+    def test_template_filter(self):
+        app.add_template_filter("shout", lambda s: s.upper() + "!")
+        t = Template("{{ 'a'|shout }}", loader=app.loader)
+        self.assertEqual(t.render(), "A!")
+
+    def test_render_streamed(self):
+        env = {
+            "HTTP_HOST": "localhost",
+            "wsgi.url_scheme": "http",
+            "SERVER_PORT": "80",
+            "PATH_INFO": "/template",
+        }
+        r = app(env, start_response)
+        self.assertTrue(inspect.isgenerator(r))
+        self.assertEqual(app._response.status, "200 OK")
+        self.assertNotIn("Content-Length", app._response.headers)
+        body = b"".join(r)
+        self.assertIn(b"<h2>Hello lunar!</h2>", body)
+        self.assertIn(b"http://localhost/static/style.css", body)
+
+    def test_template_error(self):
+        env = {
+            "HTTP_HOST": "localhost",
+            "wsgi.url_scheme": "http",
+            "SERVER_PORT": "80",
+            "PATH_INFO": "/template_error",
+        }
+        statuses = []
+        r = app(env, lambda status, headerlist: statuses.append(status))
+        self.assertEqual(statuses, ["500 Internal Server Error"])
+        self.assertEqual(list(r), [b"500 Internal Server Error"])
+
+
+@app.route("/async/<int:n>")
+async def async_handler(n):
+    await asyncio.sleep(0)
+    return "async %d %s" % (n, app.request.args["q"])
+
+
+def call_asgi(path, method="GET", query=b"", body=b"", headers=()):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "path": path,
+        "query_string": query,
+        "headers": list(headers),
+        "server": ("localhost", 80),
+    }
+    asyncio.run(app.asgi(scope, receive, send))
+    body = b"".join(m["body"] for m in messages[1:])
+    return messages[0]["status"], dict(messages[0]["headers"]), body
+
+
+class ASGITest(unittest.TestCase):
+    def test_sync_handler(self):
+        status, headers, body = call_asgi("/")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"Hello, lunar!")
+        self.assertEqual(headers[b"content-length"], b"13")
+
+    def test_async_handler(self):
+        status, headers, body = call_asgi("/async/3", query=b"q=lunar")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"async 3 lunar")
+
+    def test_async_handler_under_wsgi(self):
+        env = {"PATH_INFO": "/async/4", "QUERY_STRING": "q=wsgi"}
+        self.assertEqual(app(env, start_response), [b"async 4 wsgi"])
+
+    def test_post_form(self):
+        status, headers, body = call_asgi(
+            "/test_post",
+            method="POST",
+            body=b"title=test&tag=python",
+            headers=[(b"content-type", b"application/x-www-form-urlencoded")],
+        )
+        self.assertEqual(body, b"('test', 'python')")
+
+    def test_not_found(self):
+        status, headers, body = call_asgi("/hello")
+        self.assertEqual(status, 404)
+
+    def test_internal_error(self):
+        status, headers, body = call_asgi("/test_handler_exception")
+        self.assertEqual(status, 500)
+
+    def test_render_streamed(self):
+        status, headers, body = call_asgi("/template", headers=[(b"host", b"lunar")])
+        self.assertEqual(status, 200)
+        self.assertNotIn(b"content-length", headers)
+        self.assertIn(b"<h2>Hello lunar!</h2>", body)
+        self.assertIn(b"http://lunar/static/style.css", body)
+
+    def test_template_error(self):
+        status, headers, body = call_asgi("/template_error")
+        self.assertEqual(status, 500)
+        self.assertEqual(body, b"500 Internal Server Error")
+
+    def test_static(self):
+        status, headers, body = call_asgi("/static/style.css")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"text/css")
+        with open(os.path.join(dirname, "static", "style.css"), "rb") as f:
+            self.assertEqual(body, f.read())
+
+
+class ConcurrencyTest(unittest.TestCase):
+    def test_threads_do_not_share_request_or_response(self):
+        errors = []
+
+        def worker(t):
+            for i in range(50):
+                n = t * 1000 + i
+                headers = {}
+
+                def _start_response(status, headerlist):
+                    headers.update(headerlist)
+
+                env = {
+                    "HTTP_HOST": "localhost",
+                    "wsgi.url_scheme": "http",
+                    "SERVER_PORT": "80",
+                    "PATH_INFO": "/echo/%d" % n,
+                    "QUERY_STRING": "q=%d" % n,
+                }
+                body = b"".join(app(env, _start_response))
+                expected = "%d:%d:/echo/%d" % (n, n, n)
+                if body != expected.encode() or headers.get("X-Echo") != str(n):
+                    errors.append((expected, body, headers.get("X-Echo")))
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
@@ -0,0 +1,87 @@
+# -*- encoding: utf-8 -*-
+# Router dispatch benchmarks
+#
+# Objective: Show that the time of a single Router.get and Router.url_for
+# stays flat when the number of registered routes grows from 10 to 5,000.
+#
+# Usage:
+#
+#   $ python -m tests.router.benchmarks
+#
+# A sample output:
+#
+# -------------------------------------------------------
+# routes     static hit    dynamic hit      not found
+#     10        0.75 us        5.31 us        1.35 us
+#    100        0.76 us        5.33 us        1.48 us
+#   1000        0.83 us        5.96 us        1.80 us
+#   5000        0.52 us        5.36 us        1.50 us
+# -------------------------------------------------------
+# routes    url_for static   url_for dynamic
+#     10           0.28 us           1.26 us
+#    100           0.35 us           1.05 us
+#   1000           0.34 us           1.56 us
+#   5000           0.46 us           2.00 us
+# -------------------------------------------------------
+
+import sys
+import timeit
+
+from lunar.router import Router
+
+
+def make_handler():
+    # url_for looks routes up by callable, so each route needs its own.
+    def handler(**kwargs):
+        pass
+
+    return handler
+
+
+def build_router(count):
+    router = Router()
+    for i in range(count):
+        router.register("/static%d/page" % i, make_handler(), ["GET"])
+        router.register("/dynamic%d/<int:id>/<name>" % i, make_handler(), ["GET"])
+    return router
+
+
+def timed(fn, number):
+    return 1000000 * timeit.Timer(fn).timeit(number=number) / number
+
+
+def run(sizes=(10, 100, 1000, 5000), number=20000):
+    print("-" * 55)
+    print("%6s %14s %14s %14s" % ("routes", "static hit", "dynamic hit", "not found"))
+    for size in sizes:
+        router = build_router(size)
+        # always look up the last registered route, the worst case of a
+        # linear scan.
+        last = size - 1
+        paths = [
+            "/static%d/page" % last,
+            "/dynamic%d/42/lunar" % last,
+            "/nowhere/%d" % last,
+        ]
+        results = [timed(lambda: router.get(path), number) for path in paths]
+        print("%6d %11.2f us %11.2f us %11.2f us" % tuple([size] + results))
+    print("-" * 55)
+
+    print("%6s %17s %17s" % ("routes", "url_for static", "url_for dynamic"))
+    for size in sizes:
+        router = build_router(size)
+        static, dynamic = list(router.all_callables())[-2:]
+        results = [
+            timed(lambda: router.url_for(static), number),
+            timed(lambda: router.url_for(dynamic, id=42, name="lunar"), number),
+        ]
+        print("%6d %14.2f us %14.2f us" % tuple([size] + results))
+    print("-" * 55)
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+    if sizes:
+        run(sizes)
+    else:
+        run()
@@ -1,6 +1,7 @@
 import unittest
+import uuid
 
-from lunar.router import Router, RouterException
+from lunar.router import BaseConverter, MethodNotAllowed, Router, RouterException
 
 
 def just_a_callable():
@@ -49,12 +50,12 @@ class RouterTest(unittest.TestCase):
 
     def test_get_with_int_args(self):
         self.router.register("/show/<int:id>", just_a_callable, ["GET"])
-        self.assertEqual((just_a_callable, {"id": "1"}), self.router.get("/show/1"))
+        self.assertEqual((just_a_callable, {"id": 1}), self.router.get("/show/1"))
 
     def test_get_with_mutiple_args(self):
         self.router.register("/show/<int:id>/<date>", just_a_callable, ["GET"])
         self.assertEqual(
-            (just_a_callable, {"id": "1", "date": "2015"}),
+            (just_a_callable, {"id": 1, "date": "2015"}),
             self.router.get("/show/1/2015"),
         )
 
@@ -94,3 +95,137 @@ class RouterTest(unittest.TestCase):
         self.router.register("/post", another_callable, ["GET"])
         r = self.router.all_callables()
         self.assertEqual(set(r), set([another_callable, just_a_callable]))
+
+    def test_get_static_segment_wins_over_variable(self):
+        self.router.register("/post/<name>", just_a_callable, ["GET"])
+        self.router.register("/post/about", another_callable, ["GET"])
+        self.assertEqual((another_callable, None), self.router.get("/post/about"))
+        self.assertEqual(
+            (just_a_callable, {"name": "lunar"}), self.router.get("/post/lunar")
+        )
+
+    def test_get_with_variable_inside_segment(self):
+        self.router.register("/post-<id>.html", just_a_callable, ["GET"])
+        self.assertEqual(
+            (just_a_callable, {"id": "1"}), self.router.get("/post-1.html")
+        )
+        self.assertEqual(None, self.router.get("/post-1.htm"))
+
+    def test_get_backtracks_to_other_variable_branch(self):
+        self.router.register("/<a>/edit", just_a_callable, ["GET"])
+        self.router.register("/<a>/<b>/show", another_callable, ["GET"])
+        self.assertEqual(
+            (another_callable, {"a": "1", "b": "2"}), self.router.get("/1/2/show")
+        )
+
+    def test_get_not_found(self):
+        self.router.register("/post/about", just_a_callable, ["GET"])
+        self.assertEqual(None, self.router.get("/post"))
+        self.assertEqual(None, self.router.get("/post/about/more"))
+
+    def test_remove_all_routes(self):
+        self.router.register("/", just_a_callable, ["GET"])
+        self.router.remove_all_routes()
+        self.assertEqual(None, self.router.get("/"))
+
+    def test_get_static_route_skips_trie(self):
+        self.router.register("/new_post", just_a_callable, ["GET", "POST"])
+        self.router._root = None  # the trie must not be touched
+        self.assertEqual((just_a_callable, None), self.router.get("/new_post", "POST"))
+        self.assertRaises(RouterException, self.router.get, "/new_post", "DELETE")
+
+    def test_url_for_first_registered_rule(self):
+        self.router.register("/post", just_a_callable, ["GET"])
+        self.router.register("/article", just_a_callable, ["GET"])
+        self.assertEqual("/post", self.router.url_for(just_a_callable))
+
+    def test_url_for_with_braces_in_rule(self):
+        self.router.register("/{post}/<id>", just_a_callable, ["GET"])
+        self.assertEqual("/{post}/1", self.router.url_for(just_a_callable, id=1))
+
+    def test_get_rejects_bad_int(self):
+        self.router.register("/post/<int:id>", just_a_callable, ["GET"])
+        self.assertEqual(None, self.router.get("/post/abc"))
+
+    def test_get_with_float_args(self):
+        self.router.register("/price/<float:value>", just_a_callable, ["GET"])
+        self.assertEqual(
+            (just_a_callable, {"value": 1.5}), self.router.get("/price/1.5")
+        )
+
+    def test_get_with_path_args(self):
+        self.router.register("/files/<path:name>/raw", just_a_callable, ["GET"])
+        self.router.register("/files/<path:name>", another_callable, ["GET"])
+        self.assertEqual(
+            (just_a_callable, {"name": "a/b.txt"}),
+            self.router.get("/files/a/b.txt/raw"),
+        )
+        self.assertEqual(
+            (another_callable, {"name": "a/b.txt"}), self.router.get("/files/a/b.txt")
+        )
+
+    def test_get_with_uuid_args(self):
+        self.router.register("/u/<uuid:key>", just_a_callable, ["GET"])
+        key = "12345678-1234-5678-1234-567812345678"
+        self.assertEqual(
+            (just_a_callable, {"key": uuid.UUID(key)}), self.router.get("/u/" + key)
+        )
+        self.assertEqual(None, self.router.get("/u/1234"))
+
+    def test_get_with_slug_args(self):
+        self.router.register("/tag/<slug:name>", just_a_callable, ["GET"])
+        self.assertEqual(
+            (just_a_callable, {"name": "hello-lunar"}),
+            self.router.get("/tag/hello-lunar"),
+        )
+        self.assertEqual(None, self.router.get("/tag/hello--lunar"))
+
+    def test_get_with_custom_converter(self):
+        class HexConverter(BaseConverter):
+            regex = "[0-9a-f]+"
+
+            def to_python(self, value):
+                return int(value, 16)
+
+        self.router.add_converter("hex", HexConverter)
+        self.router.register("/color/<hex:value>", just_a_callable, ["GET"])
+        self.assertEqual(
+            (just_a_callable, {"value": 255}), self.router.get("/color/ff")
+        )
+
+    def test_add_converter_with_illegal_converter(self):
+        self.assertRaises(RouterException, self.router.add_converter, "hex", int)
+
+    def test_register_with_unknown_converter(self):
+        self.assertRaises(
+            RouterException, self.router.register, "/<foo:x>", just_a_callable, ["GET"]
+        )
+
+    def test_get_method_not_allowed_with_allowed_methods(self):
+        self.router.register("/post/<int:id>", just_a_callable, ["GET"])
+        self.router.register("/post/<int:id>", another_callable, ["POST"])
+        self.assertEqual(
+            (another_callable, {"id": 1}), self.router.get("/post/1", "POST")
+        )
+        try:
+            self.router.get("/post/1", "DELETE")
+        except MethodNotAllowed as e:
+            self.assertEqual(("GET", "HEAD", "POST"), e.allowed)
+        else:
+            self.fail("MethodNotAllowed not raised")
+
+    def test_get_with_no_methods_accept_any_method(self):
+        self.router.register("/", just_a_callable, None)
+        self.assertEqual((just_a_callable, None), self.router.get("/", "POST"))
+
+    def test_get_not_found_is_cached(self):
+        self.router.register("/post/<int:id>", just_a_callable, ["GET"])
+        self.assertEqual(None, self.router.get("/wp-login.php"))
+        self.router._root = None  # a cached miss must not touch the trie
+        self.assertEqual(None, self.router.get("/wp-login.php"))
+
+    def test_register_invalidates_cached_not_found(self):
+        self.router.register("/post", just_a_callable, ["GET"])
+        self.assertEqual(None, self.router.get("/about"))
+        self.router.register("/about", another_callable, ["GET"])
+        self.assertEqual((another_callable, None), self.router.get("/about"))
@@ -0,0 +1,216 @@
+import os
+import socket
+import threading
+import time
+import unittest
+
+from http.client import HTTPConnection
+
+from lunar.lunar import Lunar
+from lunar.server import AsyncioServer, PreforkServer, ThreadingServer, server_names
+
+
+def pid_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(os.getpid()).encode()]
+
+
+def flags_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [("%(wsgi.multithread)s %(wsgi.multiprocess)s" % environ).encode()]
+
+
+def start(server, app=pid_app):
+    t = threading.Thread(target=server.run, args=(app,))
+    t.daemon = True
+    t.start()
+    for _ in range(500):
+        if getattr(server, "httpd", None) is not None:
+            break
+        time.sleep(0.01)
+    return t, server.httpd.server_address[1]
+
+
+def get(port):
+    conn = HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", "/")
+    body = conn.getresponse().read()
+    conn.close()
+    return body
+
+
+class ThreadingServerTest(unittest.TestCase):
+    def test_concurrent_requests(self):
+        server = ThreadingServer(port=0, workers=4)
+        t, port = start(server)
+        results = []
+
+        def worker():
+            results.append(get(port))
+
+        workers = [threading.Thread(target=worker) for _ in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        server.shutdown()
+        t.join(5)
+        self.assertEqual(results, [str(os.getpid()).encode()] * 8)
+        self.assertFalse(t.is_alive())
+
+    def test_wsgi_flags(self):
+        server = ThreadingServer(port=0)
+        t, port = start(server, flags_app)
+        self.assertEqual(get(port), b"True False")
+        server.shutdown()
+        t.join(5)
+
+
+class SendfileTest(unittest.TestCase):
+    def test_static_file_with_range(self):
+        app = Lunar("__main__")
+        app.root_path = os.path.join(os.path.dirname(__file__), os.pardir, "app")
+        with open(os.path.join(app.root_path, "static", "style.css"), "rb") as f:
+            content = f.read()
+
+        server = ThreadingServer(port=0)
+        t, port = start(server, app)
+
+        conn = HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("GET", "/static/style.css")
+        self.assertEqual(conn.getresponse().read(), content)
+        conn.close()
+
+        conn = HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("GET", "/static/style.css", headers={"Range": "bytes=3-"})
+        response = conn.getresponse()
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.read(), content[3:])
+        conn.close()
+
+        server.shutdown()
+        t.join(5)
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "needs os.fork")
+class PreforkServerTest(unittest.TestCase):
+    def test_workers_are_recycled(self):
+        server = PreforkServer(port=0, workers=2, max_requests=1)
+        t, port = start(server)
+        pids = set(get(port) for _ in range(4))
+        server.shutdown()
+        t.join(5)
+        # every worker served a single request before being replaced.
+        self.assertEqual(len(pids), 4)
+        self.assertNotIn(str(os.getpid()).encode(), pids)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(server.children, set())
+
+    def test_wsgi_flags(self):
+        server = PreforkServer(port=0, workers=1)
+        t, port = start(server, flags_app)
+        self.assertEqual(get(port), b"False True")
+        server.shutdown()
+        t.join(5)
+
+
+class ServerNamesTest(unittest.TestCase):
+    def test_run_with_unknown_server_name(self):
+        app = Lunar("__main__")
+        self.assertRaises(RuntimeError, app.run, server="unknown")
+
+    def test_server_names(self):
+        self.assertIs(server_names["threading"], ThreadingServer)
+        self.assertIs(server_names["prefork"], PreforkServer)
+
+
+class AsyncioServerTest(unittest.TestCase):
+    def setUp(self):
+        app = Lunar("__main__")
+
+        @app.route("/sync/<int:n>", methods=["GET", "POST"])
+        def sync(n):
+            return "sync %d %s" % (n, app.request.method)
+
+        @app.route("/async/<int:n>")
+        async def handler(n):
+            return "async %d" % n
+
+        self.server = AsyncioServer(port=0, workers=2)
+        self.thread = threading.Thread(target=self.server.run, args=(app,))
+        self.thread.daemon = True
+        self.thread.start()
+        for _ in range(500):
+            if self.server.server_address is not None:
+                break
+            time.sleep(0.01)
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+
+    def test_keep_alive(self):
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        for n in range(3):
+            conn.request("GET", "/async/%d" % n)
+            response = conn.getresponse()
+            self.assertEqual(response.read(), ("async %d" % n).encode())
+            self.assertEqual(response.getheader("Connection"), "keep-alive")
+        conn.request("POST", "/sync/7", body=b"x=1")
+        self.assertEqual(conn.getresponse().read(), b"sync 7 POST")
+        conn.close()
+
+    def test_pipelining(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        sock.sendall(
+            b"GET /sync/1 HTTP/1.1\r\nHost: x\r\n\r\n"
+            b"GET /async/2 HTTP/1.1\r\nHost: x\r\n\r\n"
+            b"GET /missing HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n"
+        )
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        sock.close()
+        self.assertEqual(data.count(b"HTTP/1.1 "), 3)
+        self.assertLess(data.index(b"sync 1 GET"), data.index(b"async 2"))
+        self.assertIn(b"HTTP/1.1 404 Not Found", data)
+
+    def test_chunked_request_body(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        sock.sendall(
+            b"POST /sync/3 HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n3\r\nx=1\r\n0\r\n\r\n"
+        )
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        sock.close()
+        self.assertTrue(data.startswith(b"HTTP/1.1 200 OK"))
+        self.assertTrue(data.endswith(b"sync 3 POST"))
+
+    def test_body_too_large(self):
+        self.server.max_body_size = 4
+        for request in (
+            b"POST /sync/1 HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nx=123",
+            b"POST /sync/1 HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n"
+            b"\r\n3\r\nx=1\r\n2\r\n23\r\n0\r\n\r\n",
+        ):
+            sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+            sock.sendall(request)
+            response = sock.recv(65536)
+            sock.close()
+            self.assertTrue(response.startswith(b"HTTP/1.1 413 Payload Too Large"))
+
+    def test_bad_request(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        sock.sendall(b"NONSENSE\r\n\r\n")
+        self.assertTrue(sock.recv(65536).startswith(b"HTTP/1.1 400 Bad Request"))
+        sock.close()
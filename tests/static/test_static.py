@@ -0,0 +1,82 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from lunar.static import StaticIndex, parse_accept_encoding
+
+
+class StaticIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "app.css")
+        with open(self.path, "w") as f:
+            f.write("a { color: 1 }")
+        self.index = StaticIndex(interval=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def touch(self, path, content, mtime):
+        with open(path, "wb") as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def test_get(self):
+        f = self.index.get(self.path)
+        self.assertEqual(f.size, 14)
+        self.assertEqual(f.content_type, "text/css")
+        self.assertTrue(f.etag.startswith('"'))
+        self.assertTrue(f.last_modified.endswith("UTC"))
+
+    def test_get_missing_or_directory(self):
+        self.assertIsNone(self.index.get(os.path.join(self.root, "nope.css")))
+        self.assertIsNone(self.index.get(self.root))
+
+    def test_entry_trusted_within_interval(self):
+        f = self.index.get(self.path)
+        self.touch(self.path, b"changed", 1000)
+        self.assertIs(self.index.get(self.path), f)
+
+    def test_entry_revalidated_after_interval(self):
+        self.index.interval = 0
+        f = self.index.get(self.path)
+        self.assertIs(self.index.get(self.path), f)
+        self.touch(self.path, b"changed", 1000)
+        g = self.index.get(self.path)
+        self.assertEqual(g.size, 7)
+        self.assertNotEqual(g.etag, f.etag)
+
+    def test_missing_file_cached(self):
+        path = os.path.join(self.root, "late.css")
+        self.assertIsNone(self.index.get(path))
+        self.touch(path, b"1", 1000)
+        self.assertIsNone(self.index.get(path))
+        self.index.interval = 0
+        self.assertEqual(self.index.get(path).size, 1)
+
+    def test_precompressed_variants(self):
+        mtime = os.stat(self.path).st_mtime
+        self.touch(self.path + ".gz", gzip.compress(b"a { color: 1 }"), mtime + 1)
+        self.touch(self.path + ".br", b"brotli", mtime + 1)
+        f = self.index.get(self.path)
+        self.assertEqual(f.variant("gzip, deflate").encoding, "gzip")
+        self.assertEqual(f.variant("gzip, br").encoding, "br")
+        self.assertEqual(f.variant("br;q=0, gzip").encoding, "gzip")
+        self.assertIs(f.variant("identity"), f)
+        self.assertIs(f.variant(""), f)
+        self.assertEqual(f.variant("gzip").content_type, f.content_type)
+        self.assertNotEqual(f.variant("gzip").etag, f.etag)
+
+    def test_stale_precompressed_variant_ignored(self):
+        mtime = os.stat(self.path).st_mtime
+        self.touch(self.path + ".gz", b"old", mtime - 10)
+        self.assertIs(
+            self.index.get(self.path).variant("gzip"), self.index.get(self.path)
+        )
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual(
+            parse_accept_encoding("gzip;q=1.0, br; q=0, identity"), {"gzip", "identity"}
+        )
@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+# Template compile benchmarks
+#
+# Objective: Show that compiling a template (Scanner + code generation +
+# compile()) scales linearly with the size of the template source.
+#
+# Usage:
+#
+#   $ python -m tests.templates.compile_benchmarks [sizes in KB]
+#
+# A sample output:
+#
+# -------------------------------------------------------
+#     size      compile     per KB
+#     1 KB      3.34 ms    3.34 ms
+#    10 KB     14.78 ms    1.48 ms
+#   100 KB    157.91 ms    1.58 ms
+#  1000 KB   1955.19 ms    1.96 ms
+#  5000 KB   9486.40 ms    1.90 ms
+# -------------------------------------------------------
+
+import sys
+import time
+
+from lunar.template import Template
+
+unit = """<div class="row">
+  <h2>{{ title }}</h2>
+  {% for i in items %}
+  <p>{{ i }}</p>
+  {% endfor %}
+</div>
+"""
+
+
+def generate(size):
+    """Generate a template source of about 'size' bytes."""
+    return unit * (size // len(unit) + 1)
+
+
+def run(sizes=(1, 10, 100, 1000, 5000)):
+    print("-" * 55)
+    print("%9s %12s %10s" % ("size", "compile", "per KB"))
+    for kb in sizes:
+        source = generate(kb * 1024)
+        start = time.perf_counter()
+        Template(source)
+        elapsed = 1000 * (time.perf_counter() - start)
+        print("%6d KB %9.2f ms %7.2f ms" % (kb, elapsed, elapsed / kb))
+    print("-" * 55)
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+    if sizes:
+        run(sizes)
+    else:
+        run()
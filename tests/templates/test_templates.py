@@ -1,6 +1,16 @@
+import datetime
+import io
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
-from lunar.template import Template, Loader, TemplateException
+from contextlib import redirect_stderr, redirect_stdout
+from lunar.template import Scanner, Template, Loader, TemplateException
+from lunar.template import TemplateSyntaxError, main
+from lunar.template import MemoryFragmentCache, SQLiteFragmentCache
+from lunar.template import Markup, unescape
 
 
 class LoaderTests(unittest.TestCase):
@@ -9,7 +19,278 @@ class LoaderTests(unittest.TestCase):
         self.assertRaises(TemplateException, loader.load, "hello.html")
 
 
-class BaseTests(unittest.TestCase):
+class TempDirTestCase(unittest.TestCase):
+    """Writes the templates of a test into a fresh directory, self.root."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def write(self, name, source):
+        with open(os.path.join(self.root, name), "w") as f:
+            f.write(source)
+
+
+class CountingTemplate(Template):
+    parsed = 0
+
+    def _parse(self):
+        CountingTemplate.parsed += 1
+        Template._parse(self)
+
+
+class BytecodeCacheTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache)
+        self.write("layout.html", "<h1>{% block head %}{% endblock %}</h1>")
+        self.write(
+            "page.html",
+            "{% extends 'layout.html' %}\n{% block head %}{{ title }}{% endblock %}",
+        )
+        CountingTemplate.parsed = 0
+
+    def load(self, name):
+        loader = Loader(self.root, engine=CountingTemplate, bytecode_cache=self.cache)
+        return loader.load(name)
+
+    def test_cached_template_is_not_parsed(self):
+        self.assertEqual(self.load("page.html").render(title="a"), "<h1>a</h1>")
+        # the page and its layout.
+        self.assertEqual(CountingTemplate.parsed, 2)
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+        t = self.load("page.html")
+        self.assertEqual(CountingTemplate.parsed, 2)
+        self.assertEqual(t.render(title="b"), "<h1>b</h1>")
+        self.assertEqual(t.dependencies, [os.path.join(self.root, "layout.html")])
+
+    def test_changed_source(self):
+        self.load("page.html")
+        self.write("page.html", "{{ title }}!")
+        self.assertEqual(self.load("page.html").render(title="a"), "a!")
+        self.assertEqual(CountingTemplate.parsed, 3)
+
+    def test_changed_dependency(self):
+        self.load("page.html")
+        self.write("layout.html", "<p>{% block head %}{% endblock %}</p>")
+        self.assertEqual(self.load("page.html").render(title="a"), "<p>a</p>")
+        self.assertEqual(CountingTemplate.parsed, 4)
+
+    def test_escape_option(self):
+        self.assertEqual(self.load("page.html").render(title="<"), "<h1>&lt;</h1>")
+        loader = Loader(
+            self.root,
+            engine=CountingTemplate,
+            bytecode_cache=self.cache,
+            escape_option=False,
+        )
+        # compiled apart from the escaping ones.
+        self.assertEqual(loader.load("page.html").render(title="<"), "<h1><</h1>")
+        self.assertEqual(CountingTemplate.parsed, 4)
+        self.assertEqual(self.load("page.html").render(title="<"), "<h1>&lt;</h1>")
+        self.assertEqual(CountingTemplate.parsed, 4)
+
+    def test_corrupted_entry(self):
+        self.load("page.html")
+        for name in os.listdir(self.cache):
+            with open(os.path.join(self.cache, name), "wb") as f:
+                f.write(b"lunar")
+        self.assertEqual(self.load("page.html").render(title="a"), "<h1>a</h1>")
+        self.assertEqual(CountingTemplate.parsed, 4)
+
+
+class AutoReloadTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("layout.html", "<h1>{% block head %}{% endblock %}</h1>")
+        self.write(
+            "a.html", "{% extends 'layout.html' %}\n{% block head %}a{% endblock %}"
+        )
+        self.write(
+            "b.html", "{% extends 'layout.html' %}\n{% block head %}b{% endblock %}"
+        )
+
+    def write(self, name, source):
+        p = os.path.join(self.root, name)
+        mtime = os.stat(p).st_mtime_ns if os.path.exists(p) else 0
+        super().write(name, source)
+        # make sure the mtime moves, whatever the file system resolution.
+        os.utime(p, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+    def test_no_reload(self):
+        loader = Loader(self.root)
+        self.assertEqual(loader.load("a.html").render(), "<h1>a</h1>")
+        self.write("a.html", "A")
+        self.assertEqual(loader.load("a.html").render(), "<h1>a</h1>")
+
+    def test_reload(self):
+        loader = Loader(self.root, auto_reload=True, reload_interval=0)
+        self.assertEqual(loader.load("a.html").render(), "<h1>a</h1>")
+        self.write("a.html", "A")
+        self.assertEqual(loader.load("a.html").render(), "A")
+
+    def test_reload_interval(self):
+        loader = Loader(self.root, auto_reload=True, reload_interval=3600)
+        t = loader.load("a.html")
+        self.write("a.html", "A")
+        self.assertIs(loader.load("a.html"), t)
+
+    def test_reload_dependents(self):
+        loader = Loader(self.root, auto_reload=True, reload_interval=0)
+        loader.load("a.html")
+        b = loader.load("b.html")
+        self.write("layout.html", "<h2>{% block head %}{% endblock %}</h2>")
+        self.assertEqual(loader.load("a.html").render(), "<h2>a</h2>")
+        # b depends on the layout too, it was dropped with a.
+        self.assertIsNone(loader.cache.get(os.path.join(self.root, "b.html")))
+        self.assertEqual(loader.load("b.html").render(), "<h2>b</h2>")
+
+
+class SharedLoaderTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("layout.html", "<h1>{% block head %}{% endblock %}</h1>")
+        self.write("row.html", "<td>{{ i }}</td>")
+        for name in ("a.html", "b.html"):
+            self.write(
+                name,
+                "{% extends 'layout.html' %}\n"
+                "{% block head %}{% include 'row.html' %}{% endblock %}",
+            )
+        CountingTemplate.parsed = 0
+
+    def test_each_file_is_parsed_once(self):
+        loader = Loader(self.root, engine=CountingTemplate)
+        self.assertEqual(loader.load("a.html").render(i=1), "<h1><td>1</td></h1>")
+        self.assertEqual(loader.load("b.html").render(i=2), "<h1><td>2</td></h1>")
+        # a.html, b.html, layout.html and row.html
+        self.assertEqual(CountingTemplate.parsed, 4)
+        self.assertIs(loader.load("a.html").loader, loader)
+
+    def test_cache_stats(self):
+        loader = Loader(self.root)
+        loader.load("row.html")
+        loader.load("row.html")
+        self.assertEqual(loader.cache.stats()["hits"], 1)
+        self.assertEqual(loader.cache.stats()["misses"], 1)
+
+    def test_include_in_loop(self):
+        self.write("rows.html", "{% for i in l %}{% include 'row.html' %}{% endfor %}")
+        loader = Loader(self.root, engine=CountingTemplate)
+        rendered = loader.load("rows.html").render(l=[1, 2])
+        self.assertEqual(rendered, "<td>1</td><td>2</td>")
+        self.assertEqual(CountingTemplate.parsed, 2)
+
+
+class PrecompileTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        os.mkdir(os.path.join(self.root, "sub"))
+        self.write("good.html", "{{ name }}")
+        self.write(os.path.join("sub", "other.html"), "{% include 'good.html' %}")
+        self.write("bad.html", "<p>\n{% for i in l %}{{ i + }}{% endfor %}</p>")
+        self.write("notes.txt", "{{ not a template")
+
+    def test_precompile(self):
+        loader = Loader(self.root)
+        compiled, errors = loader.precompile()
+        self.assertEqual(
+            compiled,
+            [
+                os.path.join(self.root, "good.html"),
+                os.path.join(self.root, "sub", "other.html"),
+            ],
+        )
+        [(filename, e)] = errors
+        self.assertEqual(filename, os.path.join(self.root, "bad.html"))
+        self.assertIsInstance(e, TemplateSyntaxError)
+        self.assertEqual(e.filename, filename)
+        self.assertEqual(e.lineno, 2)
+        self.assertIn("bad.html, line 2", str(e))
+        good = loader.cache.get(os.path.join(self.root, "good.html"))
+        self.assertIsNotNone(good)
+
+    def test_command_line(self):
+        cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            code = main(["compile", self.root, "-b", cache])
+        self.assertEqual(code, 1)
+        self.assertIn("2 templates compiled, 1 errors.", stdout.getvalue())
+        self.assertIn("bad.html, line 2", stderr.getvalue())
+        self.assertEqual(len(os.listdir(cache)), 2)
+
+    def test_unreadable_template(self):
+        with open(os.path.join(self.root, "latin.html"), "wb") as f:
+            f.write("caf\xe9 {{ name }}".encode("latin-1"))
+        compiled, errors = Loader(self.root).precompile()
+        self.assertEqual(len(compiled), 2)
+        self.assertEqual(
+            [(os.path.basename(p), type(e)) for p, e in errors],
+            [("bad.html", TemplateSyntaxError), ("latin.html", UnicodeDecodeError)],
+        )
+
+    def test_module_command(self):
+        project = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(project))
+        p = subprocess.run(
+            [sys.executable, "-m", "lunar", "compile", self.root],
+            env=env,
+            cwd=self.root,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.assertEqual(p.returncode, 1)
+        self.assertIn(b"2 templates compiled, 1 errors.", p.stdout)
+        self.assertNotIn(b"RuntimeWarning", p.stderr)
+
+
+class ScannerTests(unittest.TestCase):
+    def test_tokens(self):
+        scanner = Scanner("a {{ b }} c {% if d %}e{% endif %}")
+        tokens = []
+        while True:
+            token = scanner.next_token
+            if token is None:
+                break
+            tokens.append((scanner.buffer_before_token, token.group()))
+        self.assertEqual(
+            tokens, [("a ", "{{ b }}"), (" c ", "{% if d %}"), ("e", "{% endif %}")],
+        )
+        self.assertTrue(scanner.empty)
+
+    def test_large_template(self):
+        source = "<p>{{ i }}</p>\n" * 20000
+        rendered = Template(source).render(i=1)
+        self.assertEqual(rendered, "<p>1</p>\n" * 20000)
+
+
+class WhitespaceTests(unittest.TestCase):
+    def test_statement_line_is_removed(self):
+        rendered = Template(
+            "<ul>\n  {% for i in l %}\n  <li>{{ i }}</li>\n  {% endfor %}\n</ul>"
+        ).render(l=[1, 2])
+        self.assertEqual(rendered, "<ul>\n  <li>1</li>\n  <li>2</li>\n</ul>")
+
+    def test_inline_statement_is_kept(self):
+        rendered = Template("a {% if True %}b{% endif %} c\n").render()
+        self.assertEqual(rendered, "a b c\n")
+
+    def test_blank_lines_are_kept(self):
+        rendered = Template("a\n\n  \nb {{ c }}\n").render(c=1)
+        self.assertEqual(rendered, "a\n\n  \nb 1\n")
+
+    def test_strip_markers(self):
+        rendered = Template("a  \n {%- if True -%}\n  b \n {%- endif %}").render()
+        self.assertEqual(rendered, "ab")
+        rendered = Template("<p>\n  {{- name -}}\n</p>").render(name="lunar")
+        self.assertEqual(rendered, "<p>lunar</p>")
+
+
+class BaseTests(TempDirTestCase):
     def test_variable(self):
         rendered = Template(
             """
@@ -152,6 +433,11 @@ class BaseTests(unittest.TestCase):
             """,
         )
 
+    def test_text_is_kept_as_is(self):
+        source = u"café ''' \"\"\" \\n \\x41 {{ name }} it's"
+        rendered = Template(source).render(name="lunar")
+        self.assertEqual(rendered, u"café ''' \"\"\" \\n \\x41 lunar it's")
+
     def test_index(self):
         rendered = Template("{{ a[2] }}").render(a=[1, 2, 3])
         self.assertEqual(rendered, "3")
@@ -164,15 +450,330 @@ class BaseTests(unittest.TestCase):
         rendered = Template("{{ a.get('hello') }}").render(a={"hello": "lunar"})
         self.assertEqual(rendered, "lunar")
 
-    # def test_escape(self):
-    #    rendered = Template("{{ content }}").render(
-    #        content="<p>hello escape</p>")
-    #    self.assertEqual(rendered, '&lt;p&gt;hello escape&lt;/p&gt;')
+    def test_escape(self):
+        rendered = Template("{{ content }}").render(content="<p>hello escape</p>")
+        self.assertEqual(rendered, "&lt;p&gt;hello escape&lt;/p&gt;")
+
+    def test_not_escape(self):
+        rendered = Template("{{ content }}", escape_option=False).render(
+            content="<p>hello escape</p>"
+        )
+        self.assertEqual(rendered, "<p>hello escape</p>")
+
+    def test_markup_is_not_escaped_twice(self):
+        t = Template("{{ a }}{{ unescape(b) }}{{ c }}")
+        rendered = t.render(
+            a=Markup("<b>&amp;</b>"), b="&lt;i&gt;", c=1, unescape=unescape
+        )
+        self.assertEqual(rendered, "<b>&amp;</b><i>1")
+
+    def test_escape_constants(self):
+        t = Template("{{ '<br>' }}")
+        self.assertEqual(t.nodes[0].text, "&lt;br&gt;")
+        t = Template("{{ '<br>' }}", escape_option=False)
+        self.assertEqual(t.render(), "<br>")
+
+    def test_implicit_loader_escape_option(self):
+        self.write("inc.html", "[{{ a }}]")
+        t = Template(
+            "{{ a }}{% include 'inc.html' %}", path=self.root, escape_option=False
+        )
+        self.assertEqual(t.render(a="<"), "<[<]")
+
+    def test_loader_escape_option(self):
+        self.write("a.html", "{{ a }}{% include 'b.html' %}")
+        self.write("b.html", "{{ a }}")
+        self.assertEqual(Loader(self.root).load("a.html").render(a="<"), "&lt;&lt;")
+        loader = Loader(self.root, escape_option=False)
+        self.assertEqual(loader.load("a.html").render(a="<"), "<<")
+
+
+class StreamTests(unittest.TestCase):
+    def test_stream(self):
+        t = Template(
+            "<table>\n{% for i in l %}\n<tr><td>{{ i }}</td></tr>\n{% endfor %}\n</table>"
+        )
+        t.chunk_size = 64
+        chunks = list(t.stream(l=range(100)))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(isinstance(c, bytes) for c in chunks))
+        self.assertTrue(all(len(c) >= 64 for c in chunks[:-1]))
+        self.assertEqual(b"".join(chunks), t.render(l=range(100)).encode("utf-8"))
+
+    def test_stream_is_lazy(self):
+        def rows():
+            for i in range(100):
+                yield i
+            raise ValueError()
+
+        t = Template("{% for i in l %}{{ i }},{% endfor %}")
+        t.chunk_size = 16
+        chunks = t.stream(l=rows())
+        self.assertTrue(next(chunks).startswith(b"0,1,2,"))
+        self.assertRaises(ValueError, list, chunks)
+
+    def test_stream_encoding(self):
+        t = Template(u"café {{ name }}")
+        t.encoding = "latin-1"
+        self.assertEqual(b"".join(t.stream(name="lunar")), b"caf\xe9 lunar")
+
 
-    # def test_not_escape(self):
-    #    rendered = Template("{{ content }}", autoescape=False).render(
-    #        content="<p>hello escape</p>")
-    #    self.assertEqual(rendered, '<p>hello escape</p>')
+class FragmentCacheTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = 0
+
+    def count(self):
+        self.calls += 1
+        return self.calls
+
+    def test_cache(self):
+        t = Template("<p>{% cache 'a' 60 %}{{ count() }}{% endcache %}</p>")
+        t.fragments = MemoryFragmentCache()
+        self.assertEqual(t.render(count=self.count), "<p>1</p>")
+        self.assertEqual(t.render(count=self.count), "<p>1</p>")
+        self.assertEqual(self.calls, 1)
+
+    def test_key_and_ttl_expressions(self):
+        t = Template(
+            "{% cache 'user-%d' % uid ttl %}{{ uid }}{{ count() }}{% endcache %}"
+        )
+        t.fragments = MemoryFragmentCache()
+        self.assertEqual(t.render(uid=1, ttl=60, count=self.count), "11")
+        self.assertEqual(t.render(uid=2, ttl=60, count=self.count), "22")
+        self.assertEqual(t.render(uid=1, ttl=60, count=self.count), "11")
+        # an expired fragment is rendered again.
+        self.assertEqual(t.render(uid=3, ttl=0, count=self.count), "33")
+        self.assertEqual(t.render(uid=3, ttl=0, count=self.count), "34")
+
+    def test_key_expressions_with_spaces(self):
+        t = Template(
+            "{% cache 'a' + b %}{{ count() }}{% endcache %}"
+            "{% cache ('nav', uid) %}{{ count() }}{% endcache %}"
+            "{% cache ('nav', uid) 60 * 5 %}{{ count() }}{% endcache %}"
+        )
+        t.fragments = MemoryFragmentCache()
+        self.assertEqual(t.render(b="b", uid=1, count=self.count), "122")
+        self.assertEqual(t.fragments.get("ab"), "1")
+        self.assertEqual(t.fragments.get(("nav", 1)), "2")
+        self.assertRaises(
+            TemplateSyntaxError, Template, "{% cache a b c %}{% endcache %}"
+        )
+
+    def test_loops_and_streams(self):
+        t = Template(
+            "{% for i in l %}{% cache i %}{{ i }}{{ count() }},{% endcache %}"
+            "{% endfor %}"
+        )
+        t.fragments = MemoryFragmentCache()
+        t.chunk_size = 1
+        self.assertEqual(b"".join(t.stream(l=[1, 2], count=self.count)), b"11,22,")
+        self.assertEqual(t.render(l=[2, 1, 3], count=self.count), "22,11,33,")
+
+    def test_nested(self):
+        t = Template(
+            "{% cache 'a' %}<{% cache 'b' %}{{ count() }}{% endcache %}>{% endcache %}"
+        )
+        t.fragments = MemoryFragmentCache()
+        self.assertEqual(t.render(count=self.count), "<1>")
+        self.assertEqual(t.fragments.get("b"), "1")
+        self.assertEqual(t.fragments.get("a"), "<1>")
+
+    def test_included_and_extended(self):
+        self.write("inner.html", "{% cache 'inner' %}I{{ x }}{% endcache %}")
+        self.write(
+            "outer.html",
+            "{% cache 'outer' %}<{% include 'inner.html' %}>{% endcache %}",
+        )
+        self.write(
+            "layout.html",
+            "{% cache 'layout' %}[{{ x }}{% endcache %}{% block body %}{% endblock %}",
+        )
+        self.write(
+            "page.html",
+            "{% extends 'layout.html' %}\n"
+            "{% block body %}{% cache 'page' %}P{{ x }}{% endcache %}{% endblock %}",
+        )
+        loader = Loader(self.root)
+        # every template numbers its own tags from 1.
+        loader.load("inner.html")
+        for name, rendered in (("outer.html", "<I1>"), ("page.html", "[1P1")):
+            t = loader.load(name)
+            t.fragments = MemoryFragmentCache()
+            self.assertEqual(t.render(x=1), rendered)
+            self.assertEqual(t.render(x=2), rendered)
+
+    def test_sqlite_store(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        source = "{% cache 'a' 60 %}{{ count() }}{% endcache %}"
+        first, second = Template(source), Template(source)
+        first.fragments = SQLiteFragmentCache(os.path.join(d, "fragments.db"))
+        second.fragments = SQLiteFragmentCache(os.path.join(d, "fragments.db"))
+        self.assertEqual(first.render(count=self.count), "1")
+        self.assertEqual(second.render(count=self.count), "1")
+        self.assertEqual(self.calls, 1)
+
+    def test_unmatched_cache_tags(self):
+        self.assertRaises(TemplateException, Template, "{% cache 'a' %}")
+        self.assertRaises(TemplateException, Template, "a{% endcache %}")
+
+
+class FoldTests(unittest.TestCase):
+    def test_fold_text(self):
+        t = Template("a{% for i in l %}{% endfor %}{{ 'b' }}{{ 1 }}c{{ d }}")
+        self.assertEqual(
+            [type(n).__name__ for n in t.nodes],
+            ["TextNode", "KeyNode", "KeyNode", "TextNode", "VariableNode"],
+        )
+        self.assertEqual(t.nodes[3].text, "b1c")
+        self.assertEqual(t.render(l=[1], d="d"), "ab1cd")
+
+
+class FilterTests(TempDirTestCase):
+    def test_builtin_filters(self):
+        t = Template(
+            "{{ s|truncate(5) }}/{{ l|join(', ') }}/{{ d|date('%d.%m.%Y') }}/"
+            "{{ n|default('-') }}/{{ s|escape }}"
+        )
+        rendered = t.render(s="<lunar>", l=[1, 2], d=datetime.date(2015, 3, 1), n=None)
+        self.assertEqual(rendered, "&lt;l.../1, 2/01.03.2015/-/&lt;lunar&gt;")
+
+    def test_chain(self):
+        t = Template("{{ names|join(' ')|truncate(7)|default('-', True) }}")
+        self.assertEqual(t.render(names=["lunar", "web"]), "luna...")
+        self.assertEqual(t.render(names=[]), "-")
+
+    def test_bitwise_or(self):
+        self.assertEqual(Template("{{ a | b }}").render(a=1, b=2), "3")
+        self.assertEqual(Template("{{ a | b|join }}").render(a={1}, b={2}), "12")
+        self.assertEqual(Template("{{ 'a|b' }}{{ [1|2] }}").render(), "a|b[3]")
+
+    def test_filters_are_bound_at_compile_time(self):
+        t = Template("{% for i in l %}{{ i|default(0) }}{% endfor %}")
+        self.assertIn("_filter_default(i, 0)", "".join(t.intermediate_list))
+        self.assertEqual(t.render(l=[1, None]), "10")
+        # not looked up in the context.
+        self.assertEqual(t.render(l=[None], default=None), "0")
+
+    def test_loader_filters(self):
+        self.write("a.html", "{{ name|upper }}{% include 'b.html' %}")
+        self.write("b.html", "{{ name|upper|truncate(2, '') }}")
+        loader = Loader(self.root)
+        self.assertRaises(NameError, loader.load("a.html").render, name="a")
+        loader.add_filter("upper", str.upper)
+        self.assertEqual(loader.load("a.html").render(name="abc"), "ABCAB")
+        self.assertNotIn("upper", Loader(self.root).filters)
+        self.assertRaises(TemplateException, loader.add_filter, "upper", None)
+
+
+class MacroTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write(
+            "forms.html",
+            "{% macro field(name, value='') %}\n"
+            '<input name="{{ name }}" value="{{ value }}">'
+            "{% endmacro %}\n"
+            "{% macro box(title) %}\n"
+            "<div>{{ title }}:{{ caller() }}</div>"
+            "{% endmacro %}\n",
+        )
+
+    def test_macro(self):
+        t = Template(
+            "{% macro li(item, cls='a') %}<li class=\"{{ cls }}\">{{ item }}</li>"
+            "{% endmacro %}{% for i in items %}{{ li(i) }}{% endfor %}{{ li(0, 'b') }}"
+        )
+        self.assertEqual(
+            t.render(items=[1, "<"]),
+            '<li class="a">1</li><li class="a">&lt;</li><li class="b">0</li>',
+        )
+        # compiled once, not inlined at every call.
+        self.assertEqual("".join(t.intermediate_list).count("<li class="), 1)
+        self.assertIn("li", t.macros)
+
+    def test_signatures(self):
+        t = Template(
+            "{% macro m(a, *args, **kw) %}"
+            "{{ a }}{{ args[0] }}{{ kw['b'] }}{{ caller() if caller else '-' }}"
+            "{% endmacro %}"
+            "{{ m(1, 2, b=3) }}{% call m(4, 5, **{'b': 6},) %}!{% endcall %}"
+        )
+        self.assertEqual(t.render(), "123-456!")
+
+    def test_macro_is_not_a_generator(self):
+        t = Template(
+            "{% macro ul(l) %}{% for i in l %}{{ i }}{% endfor %}{% endmacro %}"
+            "{{ ul(l) }}"
+        )
+        self.assertEqual(t.render(l=[1, 2]), "12")
+        t.chunk_size = 1
+        self.assertEqual(b"".join(t.stream(l=[1, 2])), b"12")
+
+    def test_import(self):
+        self.write(
+            "page.html",
+            "{% from 'forms.html' import field, box as b %}"
+            "{{ field('user', name) }}{% call b('T') %}<i>{{ name }}</i>{% endcall %}",
+        )
+        t = Loader(self.root).load("page.html")
+        self.assertEqual(
+            t.render(name="<a>"),
+            '<input name="user" value="&lt;a&gt;"><div>T:<i>&lt;a&gt;</i></div>',
+        )
+        self.assertEqual(t.dependencies, [os.path.join(self.root, "forms.html")])
+
+    def test_import_calling_a_sibling_macro(self):
+        self.write(
+            "rows.html",
+            "{% from 'forms.html' import field %}"
+            "{% macro cell(name) %}<td>{{ field(name) }}</td>{% endmacro %}"
+            "{% macro row(name) %}<tr>{{ cell(name) }}</tr>{% endmacro %}"
+            "{% macro other() %}{% endmacro %}",
+        )
+        self.write("page.html", "{% from 'rows.html' import row as r %}{{ r('a') }}")
+        t = Loader(self.root).load("page.html")
+        self.assertEqual(t.render(), '<tr><td><input name="a" value=""></td></tr>')
+        self.assertNotIn("def other", "".join(t.intermediate_list))
+
+    def test_extends(self):
+        self.write("layout.html", "<h1>{% block body %}{% endblock %}</h1>")
+        self.write(
+            "page.html",
+            "{% extends 'layout.html' %}\n"
+            "{% from 'forms.html' import field %}"
+            "{% macro m(x) %}[{{ x }}]{% endmacro %}"
+            "{% block body %}{{ field('a') }}{{ m(1) }}{% endblock %}",
+        )
+        t = Loader(self.root).load("page.html")
+        self.assertEqual(t.render(), '<h1><input name="a" value="">[1]</h1>')
+        self.assertIn("m", t.macros)
+
+    def test_import_from_bytecode_cache(self):
+        cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache)
+        self.write("page.html", "{% from 'forms.html' import field %}{{ field('a') }}")
+        Loader(self.root, bytecode_cache=cache).load("page.html")
+        self.write("other.html", "{% from 'forms.html' import field %}{{ field('b') }}")
+        t = Loader(self.root, bytecode_cache=cache).load("other.html")
+        self.assertEqual(t.render(), '<input name="b" value="">')
+
+    def test_python_import(self):
+        t = Template("{% from os.path import join %}{{ join('a', 'b') }}")
+        self.assertEqual(t.render(), os.path.join("a", "b"))
+
+    def test_errors(self):
+        self.write("page.html", "{% from 'forms.html' import nothing %}")
+        self.assertRaises(TemplateSyntaxError, Loader(self.root).load, "page.html")
+        self.assertRaises(TemplateSyntaxError, Template, "{% macro m %}{% endmacro %}")
+        self.assertRaises(TemplateSyntaxError, Template, "{% call m %}{% endcall %}")
+        self.assertRaises(TemplateException, Template, "{% macro m() %}")
+        self.assertRaises(TemplateException, Template, "{% endmacro %}")
+        self.assertRaises(TemplateException, Template, "{% macro m() %}{% endcall %}")
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            Template("{% macro m() %}\n{{ 1 + }}\n{% endmacro %}")
+        self.assertEqual(cm.exception.lineno, 2)
 
 
 class FunctionTest(unittest.TestCase):
@@ -193,6 +794,32 @@ class FunctionTest(unittest.TestCase):
         self.assertEqual(rendered, "[2, 4, 6]")
 
 
+class CompiledFunctionTests(unittest.TestCase):
+    def test_context_is_not_modified(self):
+        context = {"name": "lunar"}
+        self.assertEqual(Template("{{ name }}").render(context), "lunar")
+        self.assertEqual(context, {"name": "lunar"})
+
+    def test_undefined_name(self):
+        self.assertRaises(NameError, Template("{{ name }}").render)
+
+    def test_context_shadows_builtins(self):
+        rendered = Template("{{ len(l) }}").render(l=[1, 2], len=lambda l: "len")
+        self.assertEqual(rendered, "len")
+
+    def test_names_in_lambda_and_comprehension(self):
+        rendered = Template(
+            "{{ list(map(lambda x: x * n, l)) }} {{ [x + n for x in l] }}"
+        ).render(l=[1, 2], n=10)
+        self.assertEqual(rendered, "[10, 20] [11, 12]")
+
+    def test_loop_variable_from_context(self):
+        rendered = Template("{{ i }}{% for i in l %}{{ i }}{% endfor %}").render(
+            i=0, l=[1, 2]
+        )
+        self.assertEqual(rendered, "012")
+
+
 class SubtemplateTest(unittest.TestCase):
     def test_block_unmatched(self):
         self.assertRaises(
@@ -236,6 +863,21 @@ class SubtemplateTest(unittest.TestCase):
         )
         self.assertEqual(rendered, "<p>Included</p>")
 
+    def test_loader_globals(self):
+        loader = Loader(
+            os.path.dirname(os.path.realpath(__file__)), globals={"title": "globals"}
+        )
+        t = loader.load("test_extends.html")
+        self.assertIn("<title>globals</title>", t.render())
+        self.assertIn("<title>context</title>", t.render(title="context"))
+
+    def test_globals_are_not_copied(self):
+        t = Template("{{ a }} {{ b }} {{ len(a) }}")
+        t.globals = {"a": "ga", "len": lambda x: "glen"}
+        context = {"b": "cb"}
+        self.assertEqual(t.render(context), "ga cb glen")
+        self.assertEqual(context, {"b": "cb"})
+
 
 if __name__ == "__main__":
     unittest.main()
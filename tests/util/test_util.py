@@ -0,0 +1,106 @@
+import threading
+import time
+import unittest
+
+from lunar.util import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_lru_order(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.get("b", -1), -1)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_falsy_values(self):
+        cache = LRUCache(2)
+        cache.set("a", ())
+        self.assertEqual(cache.get("a"), ())
+        self.assertIn("a", cache)
+        cache.delete("a")
+        self.assertNotIn("a", cache)
+
+    def test_ttl(self):
+        cache = LRUCache(4, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=0)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 1)
+
+    def test_weight(self):
+        cache = LRUCache(10, weigh=len)
+        cache.set("a", "x" * 4)
+        cache.set("b", "x" * 4)
+        cache.set("c", "x" * 4)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 2)
+        # too heavy to be kept at all.
+        cache.set("d", "x" * 11)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(len(cache), 2)
+
+    def test_large_weighted_cache(self):
+        cache = LRUCache(1024, weigh=len)
+        cache.set("a", "x" * 100)
+        self.assertEqual(cache.get("a"), "x" * 100)
+        self.assertEqual(len(cache._stripes), 1)
+
+    def test_stats(self):
+        cache = LRUCache(8)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual(
+            cache.stats(),
+            {"hits": 1, "misses": 1, "evictions": 0, "size": 1, "capacity": 8},
+        )
+
+    def test_stripes(self):
+        cache = LRUCache(4096)
+        self.assertEqual(len(cache._stripes), 16)
+        for i in range(5000):
+            cache.set(i, i)
+        self.assertLessEqual(len(cache), 4096)
+        self.assertEqual(cache.get(4999), 4999)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_get_or_compute(self):
+        cache = LRUCache(8)
+        self.assertEqual(cache.get_or_compute("a", lambda: 1), 1)
+        self.assertEqual(cache.get_or_compute("a", lambda: 2), 1)
+        self.assertRaises(ZeroDivisionError, cache.get_or_compute, "b", lambda: 1 / 0)
+        self.assertNotIn("b", cache)
+
+    def test_single_flight(self):
+        cache = LRUCache(8)
+        calls = []
+        started = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return "value"
+
+        results = []
+
+        def worker():
+            results.append(cache.get_or_compute("a", compute))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ["value"] * 8)